@@ -2,9 +2,35 @@ import streamlit as st
 import os
 import json
 import re
+import time
+import random
+import secrets
+import hashlib
+import mimetypes
+import sqlite3
+import socket
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from email.utils import parsedate_to_datetime
+import io
 import base64
+import bisect
+from dataclasses import dataclass, field
 import requests
+from PIL import Image, ImageOps
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+try:  # 可选的快速JSON解析
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 # 配置基础信息
 headers = {
@@ -14,12 +40,108 @@ headers = {
 
 # 常量定义
 HISTORY_DIR = "ChatHistory"
+HISTORY_EXT = ".jsonl"
+LEGACY_EXT = ".json"
+INDEX_FILE = "index.db"
+BLOB_DIR = os.path.join(HISTORY_DIR, "blobs")
 MEMORY_FILE = "memories.json"
+METRICS_FILE = "metrics.jsonl"
+RESPONSE_CACHE_FILE = "response_cache.db"
 NUM_CONVO_DISPLAY = 10
 BASE_URL = "https://api.siliconflow.cn/v1/chat/completions"
 NAME_MODEL = "deepseek-ai/DeepSeek-V3.1"
 VLM_MODEL = "zai-org/GLM-4.5V"
 
+# 流式渲染节流：两次重绘的最小间隔（秒），以及强制重绘的累积字符数
+RENDER_INTERVAL = 0.1
+RENDER_MAX_PENDING = 2048
+
+# 性能统计：侧边栏统计最近的请求数；设置 SILICONFLOW_METRICS_PORT 后在本地提供 Prometheus 文本格式指标
+METRICS_WINDOW = 1000
+METRICS_PORT = os.getenv("SILICONFLOW_METRICS_PORT")
+
+# 响应缓存（默认关闭）：有效期（秒）、容量上限（字节），以及回放时是否按原始节奏输出
+RESPONSE_CACHE_TTL = 7 * 24 * 3600
+RESPONSE_CACHE_BYTES = 256 * 1024 * 1024
+RESPONSE_CACHE_REPLAY_TIMING = False
+
+# 网络传输：超时（秒）、重试与连接池配置
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 300
+MAX_RETRIES = 3
+RETRY_BACKOFF = 1.0
+RETRY_AFTER_MAX = 60
+RETRY_STATUS = {429, 500, 502, 503, 504}
+POOL_SIZE = 16
+# 出站请求的共享工作池：所有会话同时进行的请求数上限，排队的请求在各用户之间轮流放行
+API_WORKERS = 8
+# 单模型并发上限，未列出的模型使用默认值
+MODEL_CONCURRENCY = {
+    VLM_MODEL: 2
+}
+DEFAULT_MODEL_CONCURRENCY = 4
+
+# 后台生成：部分输出写入检查点的间隔（秒）与检查点文件后缀；已结束任务的保留时间
+CHECKPOINT_INTERVAL = 2.0
+PARTIAL_EXT = ".partial"
+GENERATION_RETENTION = 3600
+
+# 对话命名：后台线程数；设置 SILICONFLOW_LOCAL_NAMING=1 时默认使用本地启发式命名
+NAMING_WORKERS = 2
+LOCAL_NAMING = os.getenv("SILICONFLOW_LOCAL_NAMING") == "1"
+TITLE_CACHE_SIZE = 1024
+
+# 图片预处理：各模型的最长边上限（像素）、JPEG 质量与并行线程数
+IMAGE_MAX_SIDE = {
+    VLM_MODEL: 2048
+}
+DEFAULT_IMAGE_MAX_SIDE = 2048
+IMAGE_QUALITY = 85
+IMAGE_WORKERS = 4
+
+# 上下文窗口：各模型的上下文长度（token），未列出的模型使用默认值
+MODEL_CONTEXT = {
+    "deepseek-ai/DeepSeek-V3.1": 163840,
+    "Pro/deepseek-ai/DeepSeek-V3.1": 163840,
+    "Qwen/Qwen3-235B-A22B-Thinking-2507": 262144,
+    "zai-org/GLM-4.5": 131072,
+    VLM_MODEL: 65536
+}
+DEFAULT_CONTEXT = 65536
+IMAGE_TOKENS = 1024      # 每张图片的估算 token 数
+KEEP_RECENT = 2          # 最近几条消息保留图片与参考资料
+TOKEN_CACHE_SIZE = 4096
+SUMMARY_CACHE_SIZE = 256  # 早期对话摘要的缓存条数
+
+# 历史消息渲染：预处理结果缓存上限（字节），以及默认完整渲染的最近消息数
+RENDER_CACHE_BYTES = 64 * 1024 * 1024
+HISTORY_WINDOW = 20
+
+# 长对话按页加载：打开对话时读入的最近消息数，以及每个会话常驻内存的消息字节上限
+LOAD_PAGE = 50
+SESSION_MESSAGE_BYTES = 8 * 1024 * 1024
+
+# 侧边栏可选的对话模型
+CHAT_MODELS = [
+    "deepseek-ai/DeepSeek-V3.1",
+    "Qwen/Qwen3-235B-A22B-Thinking-2507",
+    "zai-org/GLM-4.5",
+    "Pro/deepseek-ai/DeepSeek-V3.1"
+]
+
+# 全文搜索：重建索引时并行读取历史文件的线程数，以及每次返回的结果数
+SEARCH_WORKERS = 4
+SEARCH_LIMIT = 20
+
+# 多用户模式：设置 SILICONFLOW_MULTI_USER=1 后每个用户使用独立的历史目录，用户名取自反向代理设置的请求头
+MULTI_USER = os.getenv("SILICONFLOW_MULTI_USER") == "1"
+USER_HEADER = os.getenv("SILICONFLOW_USER_HEADER", "X-Forwarded-User")
+USERS_DIR = os.path.join(HISTORY_DIR, "users")
+USAGE_FILE = "usage.db"
+# 用户配额（0 表示不限）：每小时请求数与每天 token 数；使用个人 API 密钥时按密钥计算
+QUOTA_REQUESTS_PER_HOUR = int(os.getenv("SILICONFLOW_QUOTA_REQUESTS", "0"))
+QUOTA_TOKENS_PER_DAY = int(os.getenv("SILICONFLOW_QUOTA_TOKENS", "0"))
+
 # 白名单处理混合推理
 HYBRID_MODEL_LIST = [
     "deepseek-ai/DeepSeek-V3.1",
@@ -31,6 +153,40 @@ HYBRID_MODEL_LIST = [
 os.makedirs(HISTORY_DIR, exist_ok=True)
 
 
+@dataclass(frozen=True)
+class Tenant:
+    """请求与历史记录的归属；单用户模式下名称为空，使用全局历史目录与 API 密钥"""
+    name: str = ""
+    api_key: str | None = field(default=None, repr=False)  # 个人 API 密钥，未设置时使用全局密钥
+
+    @property
+    def directory(self):
+        return os.path.join(USERS_DIR, self.name) if self.name else HISTORY_DIR
+
+    @property
+    def headers(self):
+        if not self.api_key:
+            return headers
+        return {**headers, "Authorization": f"Bearer {self.api_key}"}
+
+    @property
+    def quota_key(self):
+        """配额计算单位：个人密钥按密钥（只保存哈希），否则按用户"""
+        if self.api_key:
+            return "key:" + hashlib.sha256(self.api_key.encode("utf-8")).hexdigest()[:16]
+        return "user:" + self.name
+
+    @staticmethod
+    def clean_name(name):
+        """用户名用作目录名：只保留字母数字与 . @ - _"""
+        return re.sub(r"[^\w.@-]", "_", name.strip()).strip("._")[:64]
+
+    @staticmethod
+    def current():
+        """当前会话的用户（只能在脚本线程中调用）"""
+        return st.session_state.get('tenant') or Tenant()
+
+
 class SessionManager:
     """管理会话状态的类"""
 
@@ -41,10 +197,20 @@ class SessionManager:
             st.session_state.messages = []
         if 'current_convo' not in st.session_state:
             st.session_state.current_convo = None
+        if 'saved_count' not in st.session_state:
+            st.session_state.saved_count = 0  # 已写入日志文件的消息数，None 表示需要整体重写
+        if 'message_offset' not in st.session_state:
+            st.session_state.message_offset = 0  # 尚未读入内存的较早消息数，messages[0] 在文件中的位置
+        if 'loaded_from' not in st.session_state:
+            st.session_state.loaded_from = 0  # messages[0] 在日志文件中的字节偏移
         if 'convo_list' not in st.session_state:
             st.session_state.convo_list = []
+        if 'convo_total' not in st.session_state:
+            st.session_state.convo_total = 0
         if 'num_convo_display' not in st.session_state:
             st.session_state.num_convo_display = 10
+        if 'history_window' not in st.session_state:
+            st.session_state.history_window = HISTORY_WINDOW
         # 新增模型参数初始化
         if 'selected_model' not in st.session_state:
             st.session_state.selected_model = "deepseek-ai/DeepSeek-R1"
@@ -56,86 +222,1722 @@ class SessionManager:
             st.session_state.top_p = 1.0
         if 'enable_web_search' not in st.session_state:
             st.session_state.enable_web_search = False
+        if 'preprocess_images' not in st.session_state:
+            st.session_state.preprocess_images = True
+        if 'local_naming' not in st.session_state:
+            st.session_state.local_naming = LOCAL_NAMING
+        if 'context_summary' not in st.session_state:
+            st.session_state.context_summary = False
+        if 'last_context' not in st.session_state:
+            st.session_state.last_context = None
+        if 'show_metrics' not in st.session_state:
+            st.session_state.show_metrics = False
+        if 'response_cache' not in st.session_state:
+            st.session_state.response_cache = False
+        if 'force_cache' not in st.session_state:
+            st.session_state.force_cache = False
+        if 'fanout' not in st.session_state:
+            st.session_state.fanout = False
+        if 'fanout_models' not in st.session_state:
+            st.session_state.fanout_models = CHAT_MODELS[:3]
+        if 'fanout_jobs' not in st.session_state:
+            st.session_state.fanout_jobs = {}
+        if 'image_stats' not in st.session_state:
+            st.session_state.image_stats = None
+        if 'tenant' not in st.session_state:
+            st.session_state.tenant = Tenant()
+        if 'user_name' not in st.session_state:
+            st.session_state.user_name = ""
+        if 'api_key' not in st.session_state:
+            st.session_state.api_key = ""
+
+        # 后台命名完成后同步当前对话文件名
+        if st.session_state.current_convo:
+            st.session_state.current_convo = ConversationNamer.shared().resolve(st.session_state.current_convo)
 
         # 历史记录兼容（处理多模态消息）
         for msg in st.session_state.get('messages', []):
             if isinstance(msg.get("content"), list):
                 for item in msg["content"]:
-                    if item["type"] == "image_url":
+                    if item["type"] == "image_url" and "url" in item["image_url"]:
                         item["image_url"]["url"] = str(item["image_url"]["url"])
 
+    @staticmethod
+    def identify():
+        """多用户模式下确定当前用户：优先使用反向代理传入的用户名，否则显示登录表单并停止本次运行"""
+        if not MULTI_USER:
+            return
+        name = Tenant.clean_name(st.context.headers.get(USER_HEADER) or st.session_state.user_name)
+        if not name:
+            st.title("智能对话助手（支持图文）")
+            with st.form("login"):
+                user_name = st.text_input("用户名", help="对话记录按用户分别保存")
+                if st.form_submit_button("进入") and Tenant.clean_name(user_name):
+                    st.session_state.user_name = user_name
+                    st.rerun()
+            st.stop()
+        tenant = Tenant(name, st.session_state.api_key or None)
+        if tenant.name != st.session_state.tenant.name:
+            # 切换用户：关闭上一个用户的对话
+            FileManager.new_conversation()
+            st.session_state.num_convo_display = NUM_CONVO_DISPLAY
+        st.session_state.tenant = tenant
+
 
 class FileManager:
     """管理文件操作的类"""
 
     @staticmethod
-    def generate_filename(content):
-        """生成对话文件名"""
-        # 提取文本内容用于生成文件名
-        text_content = ""
+    def extract_text(content):
+        """提取消息中的文本内容"""
         if isinstance(content, list):
             texts = [item["text"] for item in content if isinstance(item, dict) and item.get("type") == "text"]
-            text_content = " ".join(texts)
-        else:
-            text_content = str(content)
+            return " ".join(texts)
+        return str(content)
 
+    @staticmethod
+    def title_payload(text_content, config=None):
+        """构建对话命名请求"""
         messages = [
             {"role": "system", "content": "你是一个对话命名助手，帮助提取对话关键词作为对话记录文件名，十五字以内。"},
             {"role": "user", "content": "提取对话的主题（仅输出主题本身）：" + text_content}
         ]
+        return ApiManager.make_payload(NAME_MODEL, messages, enable_thinking=False, stream=False, config=config)
 
-        payload = ApiManager.make_payload(NAME_MODEL, messages, enable_thinking=False, stream=False)
-        response = requests.post(BASE_URL, json=payload, headers=headers)
+    @staticmethod
+    def clean_title(title):
+        """去除文件名中的非法字符并截断"""
+        return re.sub(r'[\n\r\t\\/*?:"<>|]', "", title.strip())[:15]
 
-        clean_content = (response.json())["choices"][0]["message"].get("content", "").strip()
-        clean_content = re.sub(r'[\n\r\t\\/*?:"<>|]', "", clean_content)[:15]
-        timestamp = datetime.now().strftime("%m%d%H%M")
-        return f"{timestamp}_{clean_content}.json" if clean_content else f"{timestamp}_未命名.json"
+    @staticmethod
+    def request_title(payload, cache=None, tenant=None, transport=None, ledger=None):
+        """调用命名模型生成标题；在后台线程中执行时 transport 与 ledger 须由脚本线程取得后传入"""
+        tenant = tenant or Tenant()
+        response = (transport or HttpTransport.shared()).post(
+            BASE_URL, payload, tenant.headers, cache=cache, tenant=tenant)
+        response.raise_for_status()
+        result = response.json()
+        (ledger or UsageLedger.shared()).add(tenant, payload["model"], result.get("usage"), kind="title")
+        return FileManager.clean_title(result["choices"][0]["message"].get("content", ""))
+
+    @staticmethod
+    def local_title(text_content):
+        """本地启发式命名：取首个非空行，去掉标点与多余空白"""
+        for line in text_content.splitlines():
+            line = re.sub(r"[#>*`_~\[\]()（）【】「」《》,，.。!！?？;；:：、\"'“”‘’]", " ", line)
+            line = re.sub(r"\s+", " ", line).strip()
+            if line:
+                return FileManager.clean_title(line)
+        return ""
+
+    @staticmethod
+    def generate_filename(content, timestamp=None, ext=HISTORY_EXT):
+        """生成对话文件名"""
+        clean_content = FileManager.clean_title(content)
+        timestamp = timestamp or datetime.now().strftime("%m%d%H%M")
+        return f"{timestamp}_{clean_content}{ext}" if clean_content else f"{timestamp}_未命名{ext}"
 
     @staticmethod
     def refresh_convo_list():
-        """刷新对话列表"""
-        st.session_state.convo_list = [
-            f for f in os.listdir(HISTORY_DIR)
-            if f.endswith('.json') and os.path.getsize(os.path.join(HISTORY_DIR, f)) > 0
-        ]
-        st.session_state.convo_list.reverse()
+        """刷新对话列表（仅查询当前页）"""
+        index = ConversationIndex.shared()
+        st.session_state.convo_list = index.page(0, st.session_state.num_convo_display)
+        st.session_state.convo_total = index.count()
+
+    @staticmethod
+    def delete_conversation(filename):
+        """删除对话文件及其索引"""
+        with ConversationNamer.shared().lock:
+            path = os.path.join(Tenant.current().directory, filename)
+            for target in (path, path + PARTIAL_EXT):
+                if os.path.exists(target):
+                    os.remove(target)
+            ConversationIndex.shared().delete(filename)
 
     @staticmethod
     def new_conversation():
         """创建新对话"""
+        UIManager.clear_fanout()
         st.session_state.messages = []
         st.session_state.current_convo = None
+        st.session_state.saved_count = 0
+        st.session_state.message_offset = 0
+        st.session_state.loaded_from = 0
+        st.session_state.history_window = HISTORY_WINDOW
+        st.session_state.image_stats = None
 
     @staticmethod
     def load_conversation(filename):
-        """加载对话"""
-        path = os.path.join(HISTORY_DIR, filename)
-        with open(path, 'r', encoding='utf-8') as f:
-            st.session_state.messages = json.load(f)
+        """加载对话：日志文件只读入最近一页消息，较早的消息按需加载"""
+        UIManager.clear_fanout()
+        start = time.perf_counter()
+        path = os.path.join(Tenant.current().directory, filename)
+        first, loaded_from = 0, 0
+        if filename.endswith(HISTORY_EXT):
+            lines = ConversationStore.offsets(path)
+            first = max(len(lines) - 1 - LOAD_PAGE, 0)
+            loaded_from = lines[first]
+            messages, intact = ConversationStore.read_range(path, loaded_from, lines[-1])
+            if not intact and first:
+                first, loaded_from = 0, 0  # 日志损坏：整体读入，下次保存时重写
+                messages, intact = ConversationStore.read(path)
+        else:
+            messages, intact = ConversationStore.read(path)
+        # 进程意外退出时留下的检查点：恢复为一条中断的回答
+        if os.path.exists(path + PARTIAL_EXT) and not GenerationRegistry.shared().active(filename):
+            partial, _ = ConversationStore.read(path + PARTIAL_EXT)
+            if partial and filename.endswith(HISTORY_EXT):
+                message = dict(partial[-1], interrupted=True)
+                if FileManager.append_message(filename, message, first + len(messages)):
+                    messages.append(message)
+            os.remove(path + PARTIAL_EXT)
+        st.session_state.messages = messages
+        st.session_state.message_offset = first
+        st.session_state.loaded_from = loaded_from
         st.session_state.current_convo = filename
+        print(f"加载对话：{len(messages)}/{first + len(messages)} 条消息，"
+              f"{(os.path.getsize(path) - loaded_from) / 1024:.0f} KB，{(time.perf_counter() - start) * 1000:.0f} ms")
+        st.session_state.history_window = HISTORY_WINDOW
+        st.session_state.image_stats = None
+        # 旧格式或日志损坏时，下次保存整体重写（压缩）
+        st.session_state.saved_count = len(messages) if intact and filename.endswith(HISTORY_EXT) else None
 
     @staticmethod
     def save_conversation():
         """保存对话"""
         if st.session_state.current_convo and st.session_state.messages:
-            path = os.path.join(HISTORY_DIR, st.session_state.current_convo)
-            with open(path, 'w', encoding='utf-8') as f:
-                json.dump(st.session_state.messages, f, ensure_ascii=False, indent=2)
+            namer = ConversationNamer.shared()
+            with namer.lock:  # 避免与后台重命名交错
+                filename = namer.resolve(st.session_state.current_convo)
+                messages = st.session_state.messages
+                saved = st.session_state.saved_count
+                path = os.path.join(namer.directory, filename)
+                if filename.endswith(HISTORY_EXT) and saved is not None and saved <= len(messages) \
+                        and (saved == 0 or os.path.exists(path)):
+                    ConversationStore.append(path, messages[saved:])
+                    ConversationIndex.shared().index_messages(
+                        filename, messages[saved:], start=st.session_state.message_offset + saved)
+                else:
+                    # 整体重写前先读入尚未加载的较早消息
+                    if st.session_state.message_offset and os.path.exists(path):
+                        FileManager.load_earlier(st.session_state.message_offset)
+                        messages = st.session_state.messages
+                    st.session_state.message_offset = st.session_state.loaded_from = 0
+                    # 旧格式文件转换为日志格式
+                    old, filename = filename, os.path.splitext(filename)[0] + HISTORY_EXT
+                    ConversationStore.write(os.path.join(namer.directory, filename), messages)
+                    if filename != old:
+                        os.remove(path)
+                        ConversationIndex.shared().rename(old, filename)
+                        namer.renamed[old] = filename
+                    ConversationIndex.shared().index_messages(filename, messages)
+                st.session_state.current_convo = filename
+                st.session_state.saved_count = len(messages)
+                ConversationIndex.shared().upsert(
+                    filename, messages, count=st.session_state.message_offset + len(messages))
+            FileManager.trim_loaded()
+
+    @staticmethod
+    def load_earlier(count=LOAD_PAGE):
+        """从日志文件读入 count 条较早的消息，返回实际读入的条数"""
+        offset = st.session_state.message_offset
+        if not offset or not st.session_state.current_convo:
+            return 0
+        namer = ConversationNamer.shared()
+        with namer.lock:
+            path = os.path.join(namer.directory, namer.resolve(st.session_state.current_convo))
+            lines = ConversationStore.offsets(path)
+            first = max(offset - count, 0)
+            earlier, intact = ConversationStore.read_range(path, lines[first], lines[offset])
+        st.session_state.messages = earlier + st.session_state.messages
+        st.session_state.message_offset = first
+        st.session_state.loaded_from = lines[first]
+        if st.session_state.saved_count is not None:
+            st.session_state.saved_count = st.session_state.saved_count + len(earlier) if intact else None
+        return len(earlier)
+
+    @staticmethod
+    def load_context(model, config, use_vlm=False):
+        """已加载的消息不足上下文预算时，继续读入较早的消息"""
+        budget = ContextWindow.budget(model, config.max_tokens)
+        while st.session_state.message_offset and \
+                sum(ContextWindow.estimate(msg, use_vlm) for msg in st.session_state.messages) < budget:
+            FileManager.load_earlier()
+
+    @staticmethod
+    def trim_loaded(max_bytes=SESSION_MESSAGE_BYTES):
+        """已保存的消息超出内存上限时，从内存中释放最早的消息（至少保留一个显示窗口）"""
+        messages = st.session_state.messages
+        loaded = FileManager.loaded_bytes()
+        if loaded is None or loaded <= max_bytes or st.session_state.saved_count != len(messages):
+            return
+        path = os.path.join(Tenant.current().directory,
+                            ConversationNamer.shared().resolve(st.session_state.current_convo))
+        lines = ConversationStore.offsets(path)
+        offset = st.session_state.message_offset
+        drop = min(bisect.bisect_left(lines, lines[-1] - max_bytes) - offset, len(messages) - HISTORY_WINDOW)
+        if drop <= 0:
+            return
+        st.session_state.messages = messages[drop:]
+        st.session_state.message_offset = offset + drop
+        st.session_state.loaded_from = lines[offset + drop]
+        st.session_state.saved_count = len(messages) - drop
+        st.session_state.history_window = min(st.session_state.history_window, len(messages) - drop)
+        print(f"释放 {drop} 条较早的消息，常驻 {(lines[-1] - st.session_state.loaded_from) / 1024:.0f} KB")
+
+    @staticmethod
+    def loaded_bytes():
+        """当前对话常驻内存的消息大小（按日志文件中的字节数计），旧格式或未保存时返回 None"""
+        if not st.session_state.current_convo:
+            return None
+        path = os.path.join(Tenant.current().directory,
+                            ConversationNamer.shared().resolve(st.session_state.current_convo))
+        if not path.endswith(HISTORY_EXT) or not os.path.exists(path):
+            return None
+        return os.path.getsize(path) - st.session_state.loaded_from
+
+    @staticmethod
+    def reveal(position):
+        """展开显示窗口直到包含文件中第 position 条消息，必要时读入较早的消息"""
+        offset = st.session_state.message_offset
+        if position < offset:
+            FileManager.load_earlier(offset - position)
+        st.session_state.history_window = max(
+            st.session_state.message_offset + len(st.session_state.messages) - position, HISTORY_WINDOW)
+
+    @staticmethod
+    def append_message(filename, message, position, namer=None, index=None):
+        """向对话日志追加一条消息，不读取会话状态（可在后台线程中调用）；返回当前文件名，对话已删除时返回 None"""
+        namer = namer or ConversationNamer.shared()
+        index = index or ConversationIndex.shared()
+        with namer.lock:
+            filename = namer.resolve(filename)
+            path = os.path.join(namer.directory, filename)
+            if not os.path.exists(path):
+                return None
+            ConversationStore.append(path, [message])
+            index.index_messages(filename, [message], start=position)
+            index.upsert(filename, [message], count=position + 1)
+            return filename
+
+
+class ConversationStore:
+    """对话日志文件：每行一条消息，保存时只追加新消息
+
+    追加和整体重写都会 fsync；整体重写先写临时文件再原子替换。
+    读取时跳过崩溃造成的残缺行，并兼容旧的整体 JSON 格式。
+    """
+
+    @staticmethod
+    def encode(messages):
+        return "".join(json.dumps(msg, ensure_ascii=False, separators=(",", ":")) + "\n"
+                       for msg in messages).encode("utf-8")
+
+    @staticmethod
+    def append(path, messages):
+        """追加新消息"""
+        if not messages:
+            return
+        with open(path, 'ab') as f:
+            f.write(ConversationStore.encode(messages))
+            f.flush()
+            os.fsync(f.fileno())
+
+    @staticmethod
+    def write(path, messages):
+        """原子地整体重写（压缩）日志文件"""
+        tmp = path + ".tmp"
+        with open(tmp, 'wb') as f:
+            f.write(ConversationStore.encode(messages))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        if os.name != "nt":  # 持久化目录项
+            fd = os.open(os.path.dirname(path) or ".", os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    @staticmethod
+    def read(path):
+        """读取对话，返回 (消息列表, 文件是否完好)"""
+        if path.endswith(LEGACY_EXT):
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f), True
+        with open(path, 'rb') as f:
+            return ConversationStore.parse(f)
+
+    @staticmethod
+    def parse(lines):
+        messages = []
+        intact = True
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                messages.append(json.loads(line))
+            except ValueError:
+                intact = False  # 写入中断留下的残缺记录
+        return messages, intact
+
+    @staticmethod
+    def offsets(path, chunk_size=1024 * 1024):
+        """只扫描换行符，返回每条消息的起始字节偏移，末尾附文件长度；不解析JSON"""
+        offsets = []
+        line_start = base = 0
+        with open(path, 'rb') as f:
+            while chunk := f.read(chunk_size):
+                i = chunk.find(b"\n")
+                while i != -1:
+                    if base + i > line_start:  # 跳过空行
+                        offsets.append(line_start)
+                    line_start = base + i + 1
+                    i = chunk.find(b"\n", i + 1)
+                base += len(chunk)
+        if base > line_start:
+            offsets.append(line_start)  # 末行没有换行符（写入中断）
+        offsets.append(base)
+        return offsets
+
+    @staticmethod
+    def read_range(path, start, end):
+        """读取 [start, end) 字节范围内的消息，返回 (消息列表, 该范围是否完好)"""
+        with open(path, 'rb') as f:
+            f.seek(start)
+            return ConversationStore.parse(f.read(end - start).splitlines())
+
+
+class BlobStore:
+    """按SHA-256寻址的图片存储，消息中只保存引用 {"blob": 哈希, "mime": 类型}"""
+
+    @staticmethod
+    def path(digest, mime):
+        ext = mimetypes.guess_extension(mime) or ".bin"
+        return os.path.join(BLOB_DIR, digest[:2], digest + ext)
+
+    @staticmethod
+    def put(data: bytes, mime: str):
+        """写入图片并返回消息中的引用；相同内容只存一份"""
+        digest = hashlib.sha256(data).hexdigest()
+        path = BlobStore.path(digest, mime)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{secrets.token_hex(4)}.tmp"
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        return {"blob": digest, "mime": mime}
+
+    @staticmethod
+    def data_url(image_url):
+        """发送时才生成 data URL；旧记录中内嵌的 URL 原样返回"""
+        if "url" in image_url:
+            return image_url["url"]
+        with open(BlobStore.path(image_url["blob"], image_url["mime"]), 'rb') as f:
+            base64_str = base64.b64encode(f.read()).decode("utf-8")
+        return f"data:{image_url['mime']};base64,{base64_str}"
+
+    @staticmethod
+    def source(image_url):
+        """用于 st.image 的图片来源：存储路径，旧记录则解码内嵌数据"""
+        if "url" in image_url:
+            return base64.b64decode(image_url["url"].split(",")[1])
+        return BlobStore.path(image_url["blob"], image_url["mime"])
+
+
+class ImagePreprocessor:
+    """上传前的图片预处理：缩放、去除EXIF、重新压缩并去重"""
+
+    @staticmethod
+    def process(data: bytes, mime: str, max_side=DEFAULT_IMAGE_MAX_SIDE, quality=IMAGE_QUALITY):
+        """处理单张图片，返回 (数据, MIME类型)；无法解析时原样返回"""
+        try:
+            image = Image.open(io.BytesIO(data))
+            has_exif = bool(image.getexif())
+            image = ImageOps.exif_transpose(image)
+            resized = max(image.size) > max_side
+            if resized:
+                image.thumbnail((max_side, max_side), Image.LANCZOS)
+
+            out = io.BytesIO()
+            if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+                image.save(out, "PNG", optimize=True)
+                out_mime = "image/png"
+            else:
+                image.convert("RGB").save(out, "JPEG", quality=quality, optimize=True, progressive=True)
+                out_mime = "image/jpeg"
+        except Exception as e:
+            print(f"图片预处理失败，使用原图: {str(e)}")
+            return data, mime
+
+        if len(out.getvalue()) >= len(data) and not resized and not has_exif:
+            return data, mime
+        return out.getvalue(), out_mime
+
+    @staticmethod
+    def run(images, model=VLM_MODEL, workers=IMAGE_WORKERS):
+        """并行处理一批 (数据, MIME类型)，返回处理结果与统计信息"""
+        unique = {}
+        for data, mime in images:
+            unique.setdefault(hashlib.sha256(data).hexdigest(), (data, mime))
+        max_side = IMAGE_MAX_SIDE.get(model, DEFAULT_IMAGE_MAX_SIDE)
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="image") as pool:
+            results = list(pool.map(lambda item: ImagePreprocessor.process(*item, max_side=max_side),
+                                    unique.values()))
+        stats = {
+            "images": len(images),
+            "duplicates": len(images) - len(unique),
+            "original_bytes": sum(len(data) for data, _ in images),
+            "processed_bytes": sum(len(data) for data, _ in results),
+        }
+        return results, stats
+
+
+class ConversationIndex:
+    """基于SQLite的对话目录，侧边栏分页查询无需扫描历史目录"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS conversations (
+            id TEXT PRIMARY KEY,
+            title TEXT NOT NULL,
+            created REAL NOT NULL,
+            updated REAL NOT NULL,
+            message_count INTEGER NOT NULL,
+            model TEXT,
+            size INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS conversations_updated ON conversations (updated DESC);
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+
+        CREATE TABLE IF NOT EXISTS message_text (
+            id INTEGER PRIMARY KEY,
+            convo TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            role TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            text TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS message_text_convo ON message_text (convo);
+    """
+
+    # 全文索引需要 SQLite 3.34+ 且编译了 FTS5；不可用时搜索退回逐条扫描 message_text
+    FTS_SCHEMA = """
+        CREATE VIRTUAL TABLE IF NOT EXISTS message_fts USING fts5 (
+            text, content='message_text', content_rowid='id', tokenize='trigram'
+        );
+        CREATE TRIGGER IF NOT EXISTS message_text_ai AFTER INSERT ON message_text BEGIN
+            INSERT INTO message_fts (rowid, text) VALUES (new.id, new.text);
+        END;
+        CREATE TRIGGER IF NOT EXISTS message_text_ad AFTER DELETE ON message_text BEGIN
+            INSERT INTO message_fts (message_fts, rowid, text) VALUES ('delete', old.id, old.text);
+        END;
+    """
+
+    def __init__(self, directory=HISTORY_DIR):
+        self.directory = directory
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.conn = sqlite3.connect(os.path.join(directory, INDEX_FILE), check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.executescript(self.SCHEMA)
+            self.fts = self.create_fts()
+            migrated = self.conn.execute("SELECT value FROM meta WHERE key = 'migrated'").fetchone()
+            searchable = self.conn.execute("SELECT value FROM meta WHERE key = 'search'").fetchone()
+        if not migrated:
+            self.migrate()
+        if not searchable:
+            self.rebuild_search()
+
+    def create_fts(self):
+        """建立全文索引，返回是否可用"""
+        try:
+            self.conn.executescript(self.FTS_SCHEMA)
+            self.conn.execute("SELECT rowid FROM message_fts LIMIT 0")  # 其他环境建立的表可能无法在此打开
+        except sqlite3.OperationalError as e:
+            print(f"全文索引不可用，搜索将逐条扫描: {str(e)}")
+            # 删除引用该表的触发器，否则保存对话时写入 message_text 会失败；之后再可用时需重建
+            self.conn.executescript("DROP TRIGGER IF EXISTS message_text_ai; DROP TRIGGER IF EXISTS message_text_ad;")
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('fts_stale', '1')")
+            return False
+        if self.conn.execute("SELECT value FROM meta WHERE key = 'fts_stale'").fetchone():
+            self.conn.execute("INSERT INTO message_fts (message_fts) VALUES ('rebuild')")
+            self.conn.execute("DELETE FROM meta WHERE key = 'fts_stale'")
+        return True
+
+    @staticmethod
+    def shared(directory=None):
+        """跨会话共享的对话索引，每个历史目录一个；默认为当前用户的目录"""
+        return ConversationIndex._shared(directory or Tenant.current().directory)
+
+    @staticmethod
+    @st.cache_resource
+    def _shared(directory):
+        return ConversationIndex(directory)
+
+    @staticmethod
+    def title_of(filename):
+        """从文件名中取出标题（去掉时间戳前缀和扩展名）"""
+        stem = os.path.splitext(filename)[0]
+        return stem.split("_", 1)[1] if "_" in stem else stem
+
+    @staticmethod
+    def model_of(messages):
+        """最近一条助手消息所用的模型"""
+        for msg in reversed(messages):
+            if msg.get("role") == "assistant" and msg.get("model"):
+                return msg["model"]
+        return None
+
+    def upsert(self, filename, messages, created=None, count=None):
+        """新增或更新一条对话记录，保留原有的创建时间；count 为消息总数（默认 len(messages)）"""
+        stat = os.stat(os.path.join(self.directory, filename))
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute(
+                """INSERT INTO conversations (id, title, created, updated, message_count, model, size)
+                   VALUES (?, ?, ?, ?, ?, ?, ?)
+                   ON CONFLICT (id) DO UPDATE SET
+                       title = excluded.title, updated = excluded.updated,
+                       message_count = excluded.message_count,
+                       model = COALESCE(excluded.model, conversations.model), size = excluded.size""",
+                (filename, self.title_of(filename), created or now, stat.st_mtime if created else now,
+                 len(messages) if count is None else count, self.model_of(messages), stat.st_size))
+
+    def rename(self, old, new):
+        with self.lock, self.conn:
+            self.conn.execute("UPDATE conversations SET id = ?, title = ? WHERE id = ?",
+                              (new, self.title_of(new), old))
+            self.conn.execute("UPDATE message_text SET convo = ? WHERE convo = ?", (new, old))
+
+    def delete(self, filename):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM conversations WHERE id = ?", (filename,))
+            self.conn.execute("DELETE FROM message_text WHERE convo = ?", (filename,))
+
+    @staticmethod
+    def searchable_text(messages, start=0):
+        """提取可检索的文本（正文、推理过程、参考资料），跳过图片"""
+        rows = []
+        for position, msg in enumerate(messages, start):
+            role = msg.get("role", "")
+            if msg.get("reasoning"):
+                rows.append((position, role, "reasoning", msg["reasoning"]))
+            if isinstance(msg.get("content"), list):
+                texts = []
+                for item in msg["content"]:
+                    if item.get("type") == "text":
+                        texts.append(item.get("text", ""))
+                    elif item.get("type") == "reference":
+                        for ref in item.get("reference", []):
+                            rows.append((position, role, "reference",
+                                         f"{ref.get('title', '')}\n{ref.get('content', '')}"))
+                if texts:
+                    rows.append((position, role, "text", " ".join(texts)))
+            elif msg.get("content"):
+                rows.append((position, role, "text", str(msg["content"])))
+        return [row for row in rows if row[3].strip()]
+
+    def index_messages(self, filename, messages, start=0):
+        """增量更新全文索引；start 为 0 时先清除该对话的旧记录"""
+        rows = self.searchable_text(messages, start)
+        with self.lock, self.conn:
+            if start == 0:
+                self.conn.execute("DELETE FROM message_text WHERE convo = ?", (filename,))
+            self.conn.executemany(
+                "INSERT INTO message_text (convo, position, role, kind, text) VALUES (?, ?, ?, ?, ?)",
+                [(filename, *row) for row in rows])
+
+    def search(self, query, limit=SEARCH_LIMIT):
+        """全文检索，按相关度返回命中的消息与摘要片段"""
+        query = query.strip()
+        if not query:
+            return []
+        with self.lock:
+            if self.fts and len(query) >= 3:  # trigram 分词至少需要三个字符
+                rows = self.conn.execute(
+                    """SELECT m.convo, m.position, m.role, m.kind,
+                              snippet(message_fts, 0, '**', '**', '…', 16) AS snippet
+                       FROM message_fts JOIN message_text m ON m.id = message_fts.rowid
+                       WHERE message_fts MATCH ? ORDER BY bm25(message_fts) LIMIT ?""",
+                    ('"' + query.replace('"', '""') + '"', limit)).fetchall()
+            else:
+                rows = self.conn.execute(
+                    """SELECT m.convo, m.position, m.role, m.kind,
+                              substr(m.text, max(instr(m.text, ?) - 16, 1), 48) AS snippet
+                       FROM message_text m JOIN conversations c ON c.id = m.convo
+                       WHERE instr(m.text, ?) > 0 ORDER BY c.updated DESC LIMIT ?""",
+                    (query, query, limit)).fetchall()
+        return [dict(row) for row in rows]
+
+    def rebuild_search(self, workers=SEARCH_WORKERS):
+        """从历史目录批量重建全文索引，多线程并行读取与提取文本"""
+        print("正在建立全文搜索索引...")
+        filenames = [f for f in os.listdir(self.directory) if f.endswith((HISTORY_EXT, LEGACY_EXT))]
+
+        def extract(filename):
+            try:
+                messages, _ = ConversationStore.read(os.path.join(self.directory, filename))
+            except (OSError, ValueError) as e:
+                print(f"跳过无法读取的历史文件 {filename}: {str(e)}")
+                return filename, []
+            return filename, self.searchable_text(messages)
+
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="search") as pool:
+            extracted = list(pool.map(extract, filenames))
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM message_text")
+            if self.fts:
+                self.conn.execute("INSERT INTO message_fts (message_fts) VALUES ('delete-all')")
+            for filename, rows in extracted:
+                self.conn.executemany(
+                    "INSERT INTO message_text (convo, position, role, kind, text) VALUES (?, ?, ?, ?, ?)",
+                    [(filename, *row) for row in rows])
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('search', '1')")
+
+    def page(self, offset, limit):
+        """按更新时间倒序返回一页对话"""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT * FROM conversations ORDER BY updated DESC LIMIT ? OFFSET ?", (limit, offset)).fetchall()
+        return [dict(row) for row in rows]
+
+    def count(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM conversations").fetchone()[0]
+
+    def migrate(self):
+        """首次启动时导入已有的历史文件"""
+        print("正在建立对话索引...")
+        for filename in os.listdir(self.directory):
+            path = os.path.join(self.directory, filename)
+            if not filename.endswith((HISTORY_EXT, LEGACY_EXT)) or os.path.getsize(path) == 0:
+                continue
+            try:
+                messages, _ = ConversationStore.read(path)
+            except (OSError, ValueError) as e:
+                print(f"跳过无法读取的历史文件 {filename}: {str(e)}")
+                continue
+            self.upsert(filename, messages, created=os.path.getmtime(path))
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('migrated', '1')")
+
+
+class ConversationNamer:
+    """在后台为新对话生成标题，完成后重命名对话文件"""
+
+    def __init__(self, directory=HISTORY_DIR, workers=NAMING_WORKERS):
+        self.directory = directory
+        self.index = ConversationIndex.shared(directory)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="namer")
+        self.lock = threading.RLock()
+        self.titles = {}    # 提示词哈希 -> 标题
+        self.renamed = {}   # 临时文件名 -> 最终文件名
+
+    @staticmethod
+    def shared(directory=None):
+        """跨会话共享的命名器，每个历史目录一个；默认为当前用户的目录"""
+        return ConversationNamer._shared(directory or Tenant.current().directory)
+
+    @staticmethod
+    @st.cache_resource
+    def _shared(directory):
+        return ConversationNamer(directory)
+
+    @staticmethod
+    def provisional_name():
+        """生成临时文件名，保证同一分钟内不重复"""
+        timestamp = datetime.now().strftime("%m%d%H%M")
+        return f"{timestamp}_未命名-{secrets.token_hex(2)}{HISTORY_EXT}"
+
+    def resolve(self, filename):
+        """返回文件当前的名称"""
+        with self.lock:
+            while filename in self.renamed:
+                filename = self.renamed[filename]
+            return filename
+
+    def submit(self, filename, content, local=False, cache=None, config=None, tenant=None):
+        """提交命名任务；命中缓存或本地命名时同步完成"""
+        text_content = FileManager.extract_text(content)
+        key = hashlib.sha256(text_content.encode("utf-8")).hexdigest()
+        with self.lock:
+            title = self.titles.get(key)
+        if title is None and local:
+            title = FileManager.local_title(text_content)
+        if title is not None:
+            self.rename(filename, title)
+            return None
+        # 请求参数与共享资源都在脚本线程中取得，因此在提交前构建请求
+        payload = FileManager.title_payload(text_content, config)
+        return self.executor.submit(self._name, filename, text_content, key, payload, cache, tenant,
+                                    HttpTransport.shared(), UsageLedger.shared())
+
+    def _name(self, filename, text_content, key, payload, cache=None, tenant=None, transport=None, ledger=None):
+        print("正在生成对话文件名...")
+        try:
+            title = FileManager.request_title(payload, cache, tenant, transport, ledger)
+        except Exception as e:
+            print(f"对话命名失败，使用本地命名: {str(e)}")
+            title = FileManager.local_title(text_content)
+        else:
+            with self.lock:
+                self.titles[key] = title
+                if len(self.titles) > TITLE_CACHE_SIZE:
+                    self.titles.pop(next(iter(self.titles)))
+        self.rename(filename, title)
+        return title
+
+    def rename(self, filename, title):
+        """原子地将临时文件重命名为带标题的文件名"""
+        with self.lock:
+            filename = self.resolve(filename)
+            stem, ext = os.path.splitext(filename)
+            base = FileManager.generate_filename(title, timestamp=stem.split("_", 1)[0], ext=ext)
+            target, n = base, 1
+            while os.path.exists(os.path.join(self.directory, target)):
+                n += 1
+                target = f"{base[:-len(ext)]}({n}){ext}"
+            src = os.path.join(self.directory, filename)
+            if not os.path.exists(src):
+                return filename  # 对话已被删除
+            os.replace(src, os.path.join(self.directory, target))
+            self.index.rename(filename, target)
+            self.renamed[filename] = target
+            return target
+
+
+_connection_timing = threading.local()
+
+
+class ConnectionTimer:
+    """记录新建连接的耗时（DNS+TCP 与 TLS 握手），结果写入线程局部变量"""
+
+    def _new_conn(self):
+        start = time.perf_counter()
+        sock = super()._new_conn()
+        _connection_timing.connect = time.perf_counter() - start
+        return sock
+
+    def connect(self):
+        start = time.perf_counter()
+        super().connect()
+        _connection_timing.handshake = time.perf_counter() - start
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = type("TimedHTTPConnection", (ConnectionTimer, HTTPConnection), {})
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = type("TimedHTTPSConnection", (ConnectionTimer, HTTPSConnection), {})
+
+
+class TimedHTTPAdapter(HTTPAdapter):
+    """使用带计时连接的适配器"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": TimedHTTPConnectionPool,
+            "https": TimedHTTPSConnectionPool
+        }
+
+
+class FairScheduler:
+    """出站请求的名额：总名额与单模型并发上限都在这里分配
+
+    名额不足时按用户分别排队，按轮转顺序放行第一个“队首请求的模型仍有余量”的用户，
+    单个用户的大量请求不会阻塞其他人；所有等待都可以通过 cancelled 取消。
+    """
+
+    def __init__(self, slots=None, concurrency=None, default_concurrency=DEFAULT_MODEL_CONCURRENCY):
+        self.slots = slots   # None 表示不限总数，只受单模型上限约束
+        self.concurrency = MODEL_CONCURRENCY if concurrency is None else concurrency
+        self.default_concurrency = default_concurrency
+        self.active = 0
+        self.models = {}              # 模型 -> 进行中的请求数
+        self.queues = OrderedDict()   # 用户 -> 排队中的 (票据, 模型)，按轮转顺序排列
+        self.cond = threading.Condition()
+
+    def _available(self, model):
+        return self.models.get(model, 0) < self.concurrency.get(model, self.default_concurrency)
+
+    def _next(self):
+        """下一个可以放行的票据"""
+        if self.slots is not None and self.active >= self.slots:
+            return None
+        for queue in self.queues.values():
+            ticket, model = queue[0]
+            if self._available(model):
+                return ticket
+        return None
+
+    def acquire(self, model, tenant="", cancelled=None):
+        """等待一个名额；cancelled 被设置时放弃排队并抛出异常"""
+        ticket = object()
+        with self.cond:
+            self.queues.setdefault(tenant, []).append((ticket, model))
+            try:
+                while self._next() is not ticket:
+                    if cancelled is not None and cancelled.is_set():
+                        raise RuntimeError("请求已取消")
+                    self.cond.wait(0.1)
+            except BaseException:
+                self.queues[tenant] = [entry for entry in self.queues[tenant] if entry[0] is not ticket]
+                if not self.queues[tenant]:
+                    del self.queues[tenant]
+                self.cond.notify_all()
+                raise
+            self.queues[tenant].pop(0)
+            if self.queues[tenant]:
+                self.queues.move_to_end(tenant)  # 轮到下一个用户
+            else:
+                del self.queues[tenant]
+            self.active += 1
+            self.models[model] = self.models.get(model, 0) + 1
+            self.cond.notify_all()
+
+    def release(self, model):
+        with self.cond:
+            self.active -= 1
+            self.models[model] -= 1
+            self.cond.notify_all()
+
+    def stats(self):
+        with self.cond:
+            return {"active": self.active, "waiting": sum(len(q) for q in self.queues.values()),
+                    "tenants": len(self.queues)}
+
+
+class HttpTransport:
+    """进程级HTTP传输层：连接池复用、超时、退避重试，以及按用户公平分配的单模型并发名额"""
+
+    def __init__(self, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT,
+                 max_retries=MAX_RETRIES, backoff=RETRY_BACKOFF, pool_size=POOL_SIZE,
+                 concurrency=None, default_concurrency=DEFAULT_MODEL_CONCURRENCY, workers=None):
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.scheduler = FairScheduler(workers, concurrency, default_concurrency)
+        self.session = requests.Session()
+        adapter = TimedHTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    @staticmethod
+    @st.cache_resource
+    def shared():
+        """跨会话、跨重跑共享的传输对象，所有会话的请求共用一个名额池"""
+        return HttpTransport(workers=API_WORKERS)
+
+    def retry_delay(self, attempt, response=None):
+        """计算重试等待时间：优先遵循 Retry-After，否则使用带抖动的指数退避"""
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        if retry_after:
+            try:
+                delay = float(retry_after)
+            except ValueError:
+                try:
+                    delay = parsedate_to_datetime(retry_after).timestamp() - time.time()
+                except (TypeError, ValueError):
+                    delay = None
+            if delay is not None:
+                return min(max(delay, 0.0), RETRY_AFTER_MAX)
+        return self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+
+    def post(self, url, payload, headers, stream=False, cache=None, tenant=None, cancelled=None):
+        """发送POST请求；流式响应在关闭时才释放并发名额
+
+        cache 为 None 时不使用响应缓存；"auto" 仅缓存 temperature 为 0 的请求；"force" 总是使用缓存。
+        tenant 决定排队所属的用户与缓存的命名空间；cancelled 被设置时放弃排队与重试。
+        流式响应附带 abort()，可从其他线程中断阻塞中的读取。
+        """
+        scope = tenant.name if tenant else ""
+        key = None
+        if cache:
+            response_cache = ResponseCache.shared()
+            if ResponseCache.cacheable(payload, force=cache == "force"):
+                key = ResponseCache.key(payload, scope)
+                cached = response_cache.get(key)
+                if cached is not None:
+                    return cached
+            else:
+                response_cache.count("bypass")
+
+        model = payload.get("model")
+        self.scheduler.acquire(model, scope, cancelled)
+
+        def release():
+            self.scheduler.release(model)
+
+        def backoff(delay):
+            # 等待重试期间可被取消
+            if cancelled is not None:
+                cancelled.wait(delay)
+            else:
+                time.sleep(delay)
+
+        _connection_timing.__dict__.clear()
+        try:
+            for attempt in range(self.max_retries + 1):
+                if cancelled is not None and cancelled.is_set():
+                    raise RuntimeError("请求已取消")
+                try:
+                    response = self.session.post(url, json=payload, headers=headers,
+                                                 stream=stream, timeout=self.timeout)
+                except (requests.ConnectionError, requests.Timeout):
+                    if attempt == self.max_retries:
+                        raise
+                    backoff(self.retry_delay(attempt))
+                    continue
+                if response.status_code in RETRY_STATUS and attempt < self.max_retries:
+                    delay = self.retry_delay(attempt, response)
+                    response.close()
+                    print(f"请求返回 {response.status_code}，{delay:.1f} 秒后重试...")
+                    backoff(delay)
+                    continue
+                break
+        except BaseException:
+            release()
+            raise
+
+        connect = _connection_timing.__dict__.get("connect")
+        handshake = _connection_timing.__dict__.get("handshake")
+        response.timing = {
+            "attempts": attempt + 1,
+            "reused": connect is None,
+            "connect_ms": round(connect * 1000, 2) if connect is not None else 0.0,
+            "tls_ms": round((handshake - connect) * 1000, 2) if connect is not None and handshake else 0.0
+        }
+
+        if key is not None and response.status_code == 200:
+            response_cache.record(key, response, stream)
+
+        if not stream:
+            release()
+            return response
+
+        # 停止生成时脚本线程与任务线程可能同时关闭响应，只有先取得锁的一方释放名额
+        released = threading.Lock()
+        close = response.close
+
+        def close_and_release():
+            try:
+                close()
+            finally:
+                if released.acquire(blocking=False):
+                    release()
+
+        def abort():
+            # 关闭套接字使阻塞中的读取立即返回；名额仍由读取方关闭响应时释放，连接不会被放回连接池
+            sock = getattr(getattr(response.raw, "_connection", None), "sock", None)
+            if sock is not None:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass  # 连接已断开
+
+        response.close = close_and_release
+        response.abort = abort
+        return response
+
+
+@dataclass
+class StreamDelta:
+    """流式响应中的一个事件"""
+    content: str = ""
+    reasoning: str = ""
+    tool_calls: list = field(default_factory=list)
+    finish_reason: str | None = None
+    usage: dict | None = None
+    error: dict | None = None
+    event: str | None = None
+    done: bool = False
+
+
+class SSEParser:
+    """增量 SSE 解析器：直接处理原始字节块，支持注释、多行 data、event 字段与任意分块边界
+
+    行尾可以是 CRLF、LF 或单独的 CR。
+    """
+
+    LINE_RE = re.compile(rb"\r\n|\r|\n")
+
+    def __init__(self):
+        self.buffer = b""
+        self.data = []
+        self.event = None
+        self.events = 0
+        self.errors = 0
+
+    def feed(self, chunk: bytes):
+        """输入一个字节块，返回其中完整的事件"""
+        self.buffer += chunk
+        if b"\n" not in chunk and b"\r" not in chunk:
+            return []
+        data = self.buffer
+        if b"\r" not in data:
+            lines = data.split(b"\n")
+            self.buffer = lines.pop()
+        else:
+            # 块末尾的 \r 可能与下一块开头的 \n 组成一个换行，留到下一块一起处理
+            end = len(data) - 1 if data.endswith(b"\r") else len(data)
+            lines = self.LINE_RE.split(data[:end])
+            self.buffer = lines.pop() + data[end:]
+        deltas = []
+        for line in lines:
+            delta = self._line(line)
+            if delta is not None:
+                deltas.append(delta)
+        return deltas
+
+    def close(self):
+        """流结束：处理未以空行结尾的最后一个事件"""
+        deltas = []
+        for line in (self.buffer[:-1] if self.buffer.endswith(b"\r") else self.buffer, b""):
+            delta = self._line(line)
+            if delta is not None:
+                deltas.append(delta)
+        self.buffer = b""
+        return deltas
+
+    def parse(self, chunks):
+        """逐个产出字节块序列中的事件"""
+        for chunk in chunks:
+            yield from self.feed(chunk)
+        yield from self.close()
+
+    def _line(self, line):
+        if not line:
+            return self._dispatch()
+        if line[0] == 0x3A:  # ':' 开头为注释（心跳）
+            return None
+        name, _, value = line.partition(b":")
+        if value[:1] == b" ":
+            value = value[1:]
+        if name == b"data":
+            self.data.append(value)
+        elif name == b"event":
+            self.event = value.decode("utf-8")
+        return None
+
+    def _dispatch(self):
+        if not self.data:
+            self.event = None
+            return None
+        data = self.data[0] if len(self.data) == 1 else b"\n".join(self.data)
+        event, self.data, self.event = self.event, [], None
+        self.events += 1
+        if data == b"[DONE]":
+            return StreamDelta(event=event, done=True)
+        try:
+            payload = json_loads(data)
+        except ValueError:
+            self.errors += 1
+            print(f"无法解析的流式数据: {data[:200]!r}")
+            return None
+        return SSEParser.to_delta(payload, event)
+
+    @staticmethod
+    def to_delta(payload, event=None):
+        """将一个 chat.completion.chunk 转换为 StreamDelta"""
+        if not isinstance(payload, dict):
+            return StreamDelta(event=event, error={"message": str(payload)})
+        choice = (payload.get("choices") or [{}])[0]
+        delta = choice.get("delta") or {}
+        return StreamDelta(
+            content=delta.get("content") or "",
+            reasoning=delta.get("reasoning_content") or "",
+            tool_calls=delta.get("tool_calls") or [],
+            finish_reason=choice.get("finish_reason"),
+            usage=payload.get("usage"),
+            error=payload.get("error"),
+            event=event
+        )
+
+
+class StreamMetrics:
+    """单次流式请求的延迟与吞吐统计"""
+
+    def __init__(self, model, tenant=None, store=None, ledger=None):
+        self.model = model
+        self.tenant = tenant   # 指定时同时计入该用户的用量
+        self.store = store     # 在后台线程中结束统计时，共享的指标存储与用量账本须由脚本线程取得后传入
+        self.ledger = ledger
+        self.start = time.perf_counter()
+        self.timing = {}
+        self.headers_at = None
+        self.first_reasoning = None
+        self.first_answer = None
+        self.end = None
+        self.chunks = 0
+        self.reasoning_chars = 0
+        self.answer_chars = 0
+        self.usage = {}
+
+    def on_response(self, response):
+        self.headers_at = time.perf_counter()
+        self.timing = getattr(response, "timing", {})
+
+    def on_delta(self, reasoning, content):
+        now = time.perf_counter()
+        self.chunks += 1
+        if reasoning:
+            self.reasoning_chars += len(reasoning)
+            if self.first_reasoning is None:
+                self.first_reasoning = now
+        if content:
+            self.answer_chars += len(content)
+            if self.first_answer is None:
+                self.first_answer = now
+
+    def on_usage(self, usage):
+        if usage:
+            self.usage = usage
+
+    def _ms(self, t):
+        return round((t - self.start) * 1000, 1) if t is not None else None
+
+    def finish(self, status="ok"):
+        """结束统计，写入指标文件并返回记录"""
+        self.end = time.perf_counter()
+        first = min((t for t in (self.first_reasoning, self.first_answer) if t is not None), default=None)
+        completion = self.usage.get("completion_tokens")
+        decode = self.end - first if first is not None else 0.0
+        details = self.usage.get("completion_tokens_details") or {}
+        record = {
+            "ts": time.time(),
+            "model": self.model,
+            "status": status,
+            **self.timing,
+            "headers_ms": self._ms(self.headers_at),
+            "ttft_ms": self._ms(first),
+            "first_reasoning_ms": self._ms(self.first_reasoning),
+            "first_answer_ms": self._ms(self.first_answer),
+            "total_ms": self._ms(self.end),
+            "chunks": self.chunks,
+            "reasoning_chars": self.reasoning_chars,
+            "answer_chars": self.answer_chars,
+            "prompt_tokens": self.usage.get("prompt_tokens"),
+            "completion_tokens": completion,
+            "reasoning_tokens": self.usage.get("reasoning_tokens", details.get("reasoning_tokens")),
+            # 无 usage 时以增量块数近似 token 数
+            "tokens_per_s": round((completion or self.chunks) / decode, 2) if decode > 0 else None
+        }
+        if self.tenant is not None:
+            if self.tenant.name:
+                record["tenant"] = self.tenant.name
+            (self.ledger or UsageLedger.shared()).add(self.tenant, self.model, self.usage, status)
+        (self.store or MetricsStore.shared()).append(record)
+        print(f"首字 {record['ttft_ms']} ms，总耗时 {record['total_ms']} ms，{record['tokens_per_s']} tokens/s")
+        return record
+
+
+class MetricsStore:
+    """请求指标：追加写入JSONL文件，并提供分位数汇总与Prometheus文本格式导出"""
+
+    QUANTILE_FIELDS = ("ttft_ms", "first_answer_ms", "total_ms", "connect_ms", "tokens_per_s")
+
+    def __init__(self, path=METRICS_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        self.counters = {}   # (指标名, 模型, 标签值) -> 累计值，自进程启动起
+
+    @staticmethod
+    @st.cache_resource
+    def shared():
+        """跨会话共享的指标存储；配置端口时同时启动导出服务"""
+        store = MetricsStore()
+        if METRICS_PORT:
+            store.serve(int(METRICS_PORT))
+        return store
+
+    def append(self, record):
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self.lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line)
+            for key, value in ((("requests_total", record["model"], record["status"]), 1),
+                               (("tokens_total", record["model"], "prompt"), record.get("prompt_tokens") or 0),
+                               (("tokens_total", record["model"], "completion"), record.get("completion_tokens") or 0)):
+                self.counters[key] = self.counters.get(key, 0) + value
+
+    def recent(self, limit=METRICS_WINDOW, tail_bytes=1024 * 1024):
+        """读取最近的记录（只读取文件末尾）"""
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            f.seek(max(size - tail_bytes, 0))
+            lines = f.read().splitlines()
+        if size > tail_bytes:
+            lines = lines[1:]  # 第一行可能不完整
+        records = []
+        for line in lines[-limit:]:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+        return records
+
+    @staticmethod
+    def quantile(values, q):
+        values = sorted(values)
+        return values[min(int(q * len(values)), len(values) - 1)] if values else None
+
+    def summary(self, limit=METRICS_WINDOW):
+        """按模型汇总 p50/p95"""
+        by_model = {}
+        for record in self.recent(limit):
+            by_model.setdefault(record["model"], []).append(record)
+        rows = []
+        for model, records in sorted(by_model.items()):
+            row = {"model": model, "requests": len(records),
+                   "errors": sum(1 for r in records if r["status"] != "ok")}
+            for field in self.QUANTILE_FIELDS:
+                values = [r[field] for r in records if r.get(field) is not None]
+                row[f"{field}_p50"] = self.quantile(values, 0.5)
+                row[f"{field}_p95"] = self.quantile(values, 0.95)
+            rows.append(row)
+        return rows
+
+    def prometheus(self):
+        """Prometheus 文本格式"""
+        with self.lock:
+            counters = sorted(self.counters.items())
+        lines = []
+        for name, label_name in (("requests_total", "status"), ("tokens_total", "type")):
+            lines.append(f"# TYPE siliconflow_{name} counter")
+            lines.extend(f'siliconflow_{name}{{model="{model}",{label_name}="{label}"}} {value}'
+                         for (metric, model, label), value in counters if metric == name)
+        rows = self.summary()
+        for field in self.QUANTILE_FIELDS:
+            lines.append(f"# TYPE siliconflow_{field} summary")
+            for row in rows:
+                for q, quantile in (("p50", "0.5"), ("p95", "0.95")):
+                    if row[f"{field}_{q}"] is not None:
+                        lines.append(f'siliconflow_{field}{{model="{row["model"]}",quantile="{quantile}"}} '
+                                     f'{row[f"{field}_{q}"]}')
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port):
+        """在本地启动 /metrics 导出服务"""
+        store = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = store.prometheus().encode("utf-8")
+                self.send_response(200 if self.path == "/metrics" else 404)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True, name="metrics").start()
+        print(f"性能指标导出：http://127.0.0.1:{port}/metrics")
+        return server
+
+
+class UsageLedger:
+    """按用户记录每次请求的 token 用量，用于配额检查与用量统计"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS usage (
+            ts REAL NOT NULL,
+            tenant TEXT NOT NULL,
+            quota_key TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            model TEXT,
+            status TEXT NOT NULL,
+            prompt_tokens INTEGER NOT NULL,
+            completion_tokens INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS usage_quota_key ON usage (quota_key, ts);
+        CREATE INDEX IF NOT EXISTS usage_ts ON usage (ts);
+    """
+
+    def __init__(self, path=USAGE_FILE, requests_per_hour=QUOTA_REQUESTS_PER_HOUR,
+                 tokens_per_day=QUOTA_TOKENS_PER_DAY):
+        self.requests_per_hour = requests_per_hour
+        self.tokens_per_day = tokens_per_day
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.executescript(self.SCHEMA)
+
+    @staticmethod
+    @st.cache_resource
+    def shared():
+        """跨会话共享的用量账本"""
+        return UsageLedger()
+
+    def add(self, tenant, model, usage, status="ok", kind="chat"):
+        """记录一次请求；kind 为 chat（对话）、title（命名）或 summary（摘要），只有对话计入请求数配额"""
+        usage = usage or {}
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT INTO usage (ts, tenant, quota_key, kind, model, status, prompt_tokens, completion_tokens) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (time.time(), tenant.name, tenant.quota_key, kind, model, status,
+                 usage.get("prompt_tokens") or 0, usage.get("completion_tokens") or 0))
+
+    def usage(self, tenant, now=None):
+        """该用户（或个人密钥）近一小时的对话请求数与近一天的 token 数"""
+        now = now or time.time()
+        with self.lock:
+            requests_count = self.conn.execute(
+                "SELECT COUNT(*) FROM usage WHERE quota_key = ? AND kind = 'chat' AND ts > ?",
+                (tenant.quota_key, now - 3600)).fetchone()[0]
+            tokens = self.conn.execute(
+                "SELECT COALESCE(SUM(prompt_tokens + completion_tokens), 0) FROM usage "
+                "WHERE quota_key = ? AND ts > ?", (tenant.quota_key, now - 86400)).fetchone()[0]
+        return {"requests": requests_count, "tokens": tokens}
+
+    def exceeded(self, tenant):
+        """超出配额时返回说明，否则返回 None"""
+        if not self.requests_per_hour and not self.tokens_per_day:
+            return None
+        usage = self.usage(tenant)
+        if self.requests_per_hour and usage["requests"] >= self.requests_per_hour:
+            return f"已达到每小时 {self.requests_per_hour} 次请求的配额，请稍后再试"
+        if self.tokens_per_day and usage["tokens"] >= self.tokens_per_day:
+            return f"已达到每天 {self.tokens_per_day} tokens 的配额，请稍后再试"
+        return None
+
+    def summary(self, since):
+        """各用户自 since 起的请求数、失败数与 token 用量"""
+        with self.lock:
+            rows = self.conn.execute(
+                """SELECT tenant, COUNT(*) AS requests, SUM(status != 'ok') AS errors,
+                          SUM(prompt_tokens) AS prompt_tokens, SUM(completion_tokens) AS completion_tokens
+                   FROM usage WHERE ts > ? GROUP BY tenant ORDER BY completion_tokens DESC""",
+                (since,)).fetchall()
+        return [dict(zip(("tenant", "requests", "errors", "prompt_tokens", "completion_tokens"), row))
+                for row in rows]
+
+
+class CachedResponse:
+    """从响应缓存回放的响应，提供流式循环用到的 requests.Response 接口"""
+
+    status_code = 200
+    reason = "OK"
+    ok = True
+
+    def __init__(self, chunks, replay_timing=RESPONSE_CACHE_REPLAY_TIMING):
+        self.chunks = chunks   # [(相对首包的秒数, 字节块)]
+        self.replay_timing = replay_timing
+        self.headers = {"X-Cache": "HIT"}
+        self.timing = {"attempts": 0, "reused": True, "connect_ms": 0.0, "tls_ms": 0.0, "cached": True}
+
+    @property
+    def content(self):
+        return b"".join(chunk for _, chunk in self.chunks)
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8")
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size=None):
+        start = time.perf_counter()
+        for offset, chunk in self.chunks:
+            if self.replay_timing:
+                time.sleep(max(offset - (time.perf_counter() - start), 0))
+            yield chunk
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ResponseCache:
+    """持久化的响应缓存：以规范化请求负载的哈希为键，保存原始分块，支持TTL与按容量LRU淘汰"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS entries (
+            key TEXT PRIMARY KEY,
+            created REAL NOT NULL,
+            last_used REAL NOT NULL,
+            size INTEGER NOT NULL,
+            chunks BLOB NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used);
+        CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL);
+    """
+
+    def __init__(self, path=RESPONSE_CACHE_FILE, ttl=RESPONSE_CACHE_TTL, max_bytes=RESPONSE_CACHE_BYTES):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.executescript(self.SCHEMA)
+
+    @staticmethod
+    @st.cache_resource
+    def shared():
+        """跨会话共享的响应缓存"""
+        return ResponseCache()
+
+    @staticmethod
+    def mode():
+        """当前会话的缓存设置（需在脚本线程中调用）"""
+        if not st.session_state.get('response_cache'):
+            return None
+        return "force" if st.session_state.get('force_cache') else "auto"
+
+    @staticmethod
+    def key(payload, scope=""):
+        """scope 为用户名时各用户的缓存互不可见；单用户模式下为空"""
+        canonical = json.dumps(payload, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256((scope + "\n" + canonical if scope else canonical).encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def cacheable(payload, force=False):
+        """temperature 大于 0 的请求结果不确定，除非强制否则不缓存"""
+        return force or payload.get("temperature", 1.0) == 0
+
+    def count(self, name, n=1):
+        with self.lock, self.conn:
+            self.conn.execute("INSERT INTO stats (name, value) VALUES (?, ?) "
+                              "ON CONFLICT (name) DO UPDATE SET value = value + excluded.value", (name, n))
+
+    def get(self, key):
+        """命中时返回 CachedResponse，过期或未命中返回 None"""
+        now = time.time()
+        with self.lock, self.conn:
+            row = self.conn.execute("SELECT created, chunks FROM entries WHERE key = ?", (key,)).fetchone()
+            if row and now - row[0] > self.ttl:
+                self.conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                row = None
+            if row:
+                self.conn.execute("UPDATE entries SET last_used = ? WHERE key = ?", (now, key))
+        self.count("hits" if row else "misses")
+        if not row:
+            return None
+        chunks = [(offset, base64.b64decode(chunk)) for offset, chunk in json.loads(row[1])]
+        return CachedResponse(chunks)
+
+    def put(self, key, chunks):
+        data = json.dumps([(round(offset, 4), base64.b64encode(chunk).decode("ascii")) for offset, chunk in chunks])
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO entries (key, created, last_used, size, chunks) "
+                              "VALUES (?, ?, ?, ?, ?)", (key, now, now, len(data), data))
+            total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+            while total > self.max_bytes:
+                oldest = self.conn.execute(
+                    "SELECT key, size FROM entries ORDER BY last_used LIMIT 1").fetchone()
+                self.conn.execute("DELETE FROM entries WHERE key = ?", (oldest[0],))
+                total -= oldest[1]
+        self.count("stores")
+
+    def record(self, key, response, stream):
+        """记录真实响应：非流式立即保存；流式读到结束标记后按原始分块保存，中途取消则不保存"""
+        if not stream:
+            self.put(key, [(0.0, response.content)])
+            return
+        iter_content = response.iter_content
+
+        def recording_iter_content(chunk_size=None):
+            # 由解析器判断结束标记：回答正文中出现的 "[DONE]" 不算结束
+            parser = SSEParser()
+            chunks = []
+            finished = False
+            start = time.perf_counter()
+
+            def finish(deltas):
+                """读到结束标记时保存；流中带有错误事件时不保存，以免之后的相同请求重放错误"""
+                for delta in deltas:
+                    if delta.error:
+                        return True
+                    if delta.done:
+                        self.put(key, chunks)  # 调用方读到结束标记后可能不再继续迭代
+                        return True
+                return False
+
+            for chunk in iter_content(chunk_size=chunk_size):
+                if not finished:
+                    chunks.append((time.perf_counter() - start, chunk))
+                    finished = finish(parser.feed(chunk))
+                yield chunk
+            if not finished:
+                finish(parser.close())
+
+        response.iter_content = recording_iter_content
+
+    def stats(self):
+        with self.lock:
+            counters = dict(self.conn.execute("SELECT name, value FROM stats").fetchall())
+            entries, size = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        hits, misses = counters.get("hits", 0), counters.get("misses", 0)
+        return {**counters, "entries": entries, "bytes": size,
+                "hit_rate": hits / (hits + misses) if hits + misses else 0.0}
+
+
+class ContextWindow:
+    """按模型上下文预算裁剪历史消息
+
+    依次尝试：去掉较早消息中的图片、去掉较早消息中的参考资料、丢弃最早的消息
+    （可选用摘要代替被丢弃的消息）。不依赖会话状态，可离线测试。
+    """
+
+    CJK_RE = re.compile(r"[\u3000-\u303f\u3400-\u9fff\uf900-\ufaff\uff00-\uffef]")
+    _token_cache = OrderedDict()   # 跨会话与线程共享，读写都要持有锁
+    _token_lock = threading.Lock()
+
+    @staticmethod
+    def estimate_text(text: str) -> int:
+        """粗略估算：中日韩字符约 1 token/字，其余约 4 字符/token"""
+        cjk = len(ContextWindow.CJK_RE.findall(text))
+        return cjk + (len(text) - cjk + 3) // 4
+
+    @staticmethod
+    def estimate(msg, use_vlm=False) -> int:
+        """估算单条消息发送给API时的 token 数（带缓存）"""
+        key = (hashlib.sha256(json.dumps(msg["content"], ensure_ascii=False, sort_keys=True).encode("utf-8"))
+               .hexdigest(), use_vlm)
+        cache = ContextWindow._token_cache
+        with ContextWindow._token_lock:
+            if key in cache:
+                cache.move_to_end(key)
+                return cache[key]
+        content = ApiManager.convert_messages_for_api([msg], use_vlm, materialize=False)[0]["content"]
+        if isinstance(content, list):
+            tokens = sum(IMAGE_TOKENS if item["type"] == "image_url" else ContextWindow.estimate_text(item["text"])
+                         for item in content)
+        else:
+            tokens = ContextWindow.estimate_text(content)
+        tokens += 4  # 角色与分隔符开销
+        with ContextWindow._token_lock:
+            cache[key] = tokens
+            while len(cache) > TOKEN_CACHE_SIZE:
+                cache.popitem(last=False)
+        return tokens
+
+    @staticmethod
+    def budget(model, max_tokens):
+        """可用于输入的 token 数：为输出预留 max_tokens，但最多预留一半上下文"""
+        context = MODEL_CONTEXT.get(model, DEFAULT_CONTEXT)
+        return context - min(max_tokens, context // 2)
+
+    @staticmethod
+    def strip(msg, item_type, placeholder):
+        """返回去掉指定类型内容后的消息副本"""
+        if not isinstance(msg["content"], list):
+            return msg, 0
+        kept = [item for item in msg["content"] if item.get("type") != item_type]
+        removed = len(msg["content"]) - len(kept)
+        if not removed:
+            return msg, 0
+        if placeholder:
+            kept.append({"type": "text", "text": placeholder})
+        return {**msg, "content": kept}, removed
+
+    @staticmethod
+    def fit(messages, model, max_tokens, use_vlm=False, summarize=None):
+        """返回 (裁剪后的消息, 裁剪报告)"""
+        budget = ContextWindow.budget(model, max_tokens)
+        messages = list(messages)
+        total = sum(ContextWindow.estimate(msg, use_vlm) for msg in messages)
+        report = {"budget": budget, "before": total, "dropped_images": 0,
+                  "dropped_references": 0, "dropped_messages": 0, "summarized": False}
+
+        older = max(len(messages) - KEEP_RECENT, 0)
+        for item_type, placeholder, field in (("image_url", "[图片已省略]", "dropped_images"),
+                                              ("reference", "", "dropped_references")):
+            for i in range(older):
+                if total <= budget:
+                    break
+                stripped, removed = ContextWindow.strip(messages[i], item_type, placeholder)
+                if removed:
+                    total += ContextWindow.estimate(stripped, use_vlm) - ContextWindow.estimate(messages[i], use_vlm)
+                    messages[i] = stripped
+                    report[field] += removed
+
+        dropped = []
+        while total > budget and len(messages) > 1:
+            msg = messages.pop(0)
+            dropped.append(msg)
+            total -= ContextWindow.estimate(msg, use_vlm)
+        # 保证以用户消息开头
+        while len(messages) > 1 and messages[0]["role"] == "assistant":
+            msg = messages.pop(0)
+            dropped.append(msg)
+            total -= ContextWindow.estimate(msg, use_vlm)
+        report["dropped_messages"] = len(dropped)
+
+        if dropped and summarize:
+            try:
+                summary = {"role": "system", "content": "以下是较早对话的摘要：\n" + summarize(dropped)}
+            except Exception as e:
+                print(f"生成对话摘要失败: {str(e)}")
+            else:
+                messages.insert(0, summary)
+                total += ContextWindow.estimate(summary, use_vlm)
+                report["summarized"] = True
+
+        report["after"] = total
+        report["trimmed"] = bool(report["dropped_images"] or report["dropped_references"] or dropped)
+        return messages, report
+
+
+@dataclass
+class ApiConfig:
+    """生成参数；界面由会话状态构建，命令行等无界面场景直接构造"""
+    max_tokens: int = 2048
+    temperature: float = 1.0
+    top_p: float = 1.0
+    context_summary: bool = False  # 超出上下文预算时是否为较早的消息生成摘要
+
+    @staticmethod
+    def from_session():
+        """读取侧边栏中的参数（只能在脚本线程中调用）"""
+        return ApiConfig(
+            max_tokens=st.session_state.max_tokens,
+            temperature=st.session_state.temperature,
+            top_p=st.session_state.top_p,
+            context_summary=st.session_state.context_summary
+        )
 
 
 class ApiManager:
     """管理API相关操作的类"""
 
+    _summary_cache = OrderedDict()
+    _summary_lock = threading.Lock()
+
     @staticmethod
-    def make_payload(model: str, messages: list, enable_thinking: bool | None = None, stream: bool = True):
-        """构建请求负载"""
+    def make_payload(model: str, messages: list, enable_thinking: bool | None = None, stream: bool = True,
+                     config: ApiConfig | None = None):
+        """构建请求负载（未指定 config 时使用默认参数）"""
+        config = config or ApiConfig()
         payload = {
             "model": model,
             "messages": messages,
-            "max_tokens": st.session_state.max_tokens,
-            "temperature": st.session_state.temperature,
-            "top_p": st.session_state.top_p,
+            "max_tokens": config.max_tokens,
+            "temperature": config.temperature,
+            "top_p": config.top_p,
             "stream": stream
         }
 
@@ -145,8 +1947,8 @@ class ApiManager:
         return payload
 
     @staticmethod
-    def convert_messages_for_api(messages, use_vlm):
-        """转换消息格式适配不同模型"""
+    def convert_messages_for_api(messages, use_vlm, materialize=True):
+        """转换消息格式适配不同模型（materialize=False 时不读取图片数据）"""
         converted = []
         for msg in messages:
             if use_vlm:
@@ -156,7 +1958,8 @@ class ApiManager:
                         if item["type"] in ["text", "image_url"]:  # 只保留这两种类型
                             content_item = {"type": item["type"]}
                             if item["type"] == "image_url":
-                                content_item["image_url"] = {"url": item["image_url"]["url"]}
+                                content_item["image_url"] = {"url": BlobStore.data_url(item["image_url"])
+                                                             if materialize else ""}
                             elif item["type"] == "text":
                                 content_item["text"] = item.get("text", "")
                             content.append(content_item)
@@ -181,83 +1984,530 @@ class ApiManager:
         return converted
 
     @staticmethod
-    def send_request(model, messages, use_vlm=False):
-        """发送API请求并处理响应"""
+    def summarize(messages, config=None, cache=None, tenant=None):
+        """用命名模型为较早的对话生成摘要（按内容缓存）"""
+        text = "\n".join(f"{msg['role']}: {msg['content']}"
+                         for msg in ApiManager.convert_messages_for_api(messages, use_vlm=False))
+        key = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        with ApiManager._summary_lock:
+            if key in ApiManager._summary_cache:
+                ApiManager._summary_cache.move_to_end(key)
+                return ApiManager._summary_cache[key]
+        payload = ApiManager.make_payload(NAME_MODEL, [
+            {"role": "system", "content": "你是一个对话摘要助手，用简洁的要点概括对话中的关键信息与结论，五百字以内。"},
+            {"role": "user", "content": text}
+        ], enable_thinking=False, stream=False, config=config)
+        tenant = tenant or Tenant()
+        response = HttpTransport.shared().post(BASE_URL, payload, tenant.headers, cache=cache, tenant=tenant)
+        response.raise_for_status()
+        result = response.json()
+        UsageLedger.shared().add(tenant, NAME_MODEL, result.get("usage"), kind="summary")
+        summary = result["choices"][0]["message"].get("content", "").strip()
+        with ApiManager._summary_lock:
+            ApiManager._summary_cache[key] = summary
+            while len(ApiManager._summary_cache) > SUMMARY_CACHE_SIZE:
+                ApiManager._summary_cache.popitem(last=False)
+        return summary
+
+    @staticmethod
+    def iter_stream(response):
+        """逐个产出流式响应中的增量事件，遇到 [DONE] 结束"""
+        deltas = SSEParser().parse(response.iter_content(chunk_size=None))
+        for delta in deltas:
+            if delta.error:
+                raise RuntimeError(f"流式响应错误: {delta.error.get('message', delta.error)}")
+            if delta.done:
+                for _ in deltas:
+                    pass  # 读完剩余的结束块，连接才会放回连接池而不是被关闭
+                return
+            yield delta
+
+    @staticmethod
+    def build_request(model, messages, use_vlm=False, config=None, cache=None, tenant=None):
+        """按上下文预算裁剪历史并构建流式请求负载，返回 (负载, 裁剪报告)"""
+        config = config or ApiConfig()
+        messages, report = ContextWindow.fit(
+            messages, model, config.max_tokens, use_vlm,
+            summarize=(lambda dropped: ApiManager.summarize(dropped, config, cache, tenant))
+            if config.context_summary else None
+        )
+        if report["trimmed"]:
+            print(f"上下文已裁剪：{report}")
+        api_messages = ApiManager.convert_messages_for_api(messages, use_vlm)
+        payload = ApiManager.make_payload(
+            model=model,
+            messages=api_messages,
+            enable_thinking=True if model in HYBRID_MODEL_LIST else None,
+            config=config
+        )
+        return payload, report
+
+    @staticmethod
+    def open_stream(payload, transport=None, cache=None, url=None, tenant=None, cancelled=None,
+                    store=None, ledger=None):
+        """发起流式请求，返回附带 metrics 的响应；失败时抛出异常（可在后台线程中调用）
+
+        指定 tenant 时使用该用户的密钥、参与公平排队并计入其用量。在后台线程中调用时，
+        transport、store 与 ledger 须由脚本线程取得后传入。
+        """
+        print("正在发送api请求...")
+        metrics = StreamMetrics(payload["model"], tenant, store, ledger)
         try:
-            api_messages = ApiManager.convert_messages_for_api(messages, use_vlm)
-            payload = ApiManager.make_payload(
-                model=model, 
-                messages=api_messages, 
-                enable_thinking=True if model in HYBRID_MODEL_LIST else None
-            )
+            response = (transport or HttpTransport.shared()).post(
+                url or BASE_URL, payload, (tenant or Tenant()).headers, stream=True, cache=cache,
+                tenant=tenant, cancelled=cancelled)
+        except Exception:
+            metrics.finish("error")
+            raise
+        metrics.on_response(response)
+        if not response.ok:
+            detail = response.text[:200]
+            response.close()
+            metrics.finish(f"http_{response.status_code}")
+            raise requests.HTTPError(f"{response.status_code} {response.reason}: {detail}")
+        response.metrics = metrics
+        return response
 
-            print("正在发送api请求...")
-            response = requests.post(BASE_URL, json=payload, headers=headers, stream=True)
-            return response
+
+class StreamJob:
+    """在后台线程中消费单个模型的流式响应，增量写入缓冲区；取消时关闭HTTP连接
+
+    指定 convo 时，生成过程中定期把部分输出写入检查点文件，结束后（包括停止或失败）
+    由任务自己把回答追加到对话日志的 position 处，不依赖页面脚本是否仍在运行。
+    """
+
+    def __init__(self, payload, report=None, convo=None, position=None):
+        self.model = payload["model"]
+        self.payload = payload
+        self.report = report
+        self.convo = convo
+        self.position = position
+        self.transport = HttpTransport.shared()  # 在脚本线程中取得共享资源、缓存设置与当前用户
+        self.cache = ResponseCache.mode()
+        self.tenant = Tenant.current()
+        self.namer = ConversationNamer.shared()
+        self.index = ConversationIndex.shared()
+        self.store = MetricsStore.shared()
+        self.ledger = UsageLedger.shared()
+        self.checkpoint_path = None
+        self.saved = False
+        self.finished = None
+        self.reasoning_parts = []
+        self.answer_parts = []
+        self.status = "running"
+        self.error = None
+        self.record = None
+        self.response = None
+        self.cancelled = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True, name=f"stream-{self.model}")
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    @property
+    def running(self):
+        return self.status == "running"
+
+    @property
+    def reasoning(self):
+        return "".join(self.reasoning_parts)
+
+    @property
+    def answer(self):
+        return "".join(self.answer_parts)
+
+    def cancel(self):
+        """停止生成：中断底层连接上的读取，不影响其他任务；响应由任务线程关闭"""
+        self.cancelled.set()
+        response = self.response
+        if response is not None:
+            getattr(response, "abort", response.close)()  # 缓存回放的响应没有连接，直接关闭
+
+    def _run(self):
+        metrics = None
+        try:
+            self.response = response = ApiManager.open_stream(
+                self.payload, self.transport, self.cache, tenant=self.tenant, cancelled=self.cancelled,
+                store=self.store, ledger=self.ledger)
+            metrics = response.metrics
+            if self.cancelled.is_set():
+                response.close()
+            last_checkpoint = time.monotonic()
+            with response:
+                for delta in ApiManager.iter_stream(response):
+                    if self.cancelled.is_set():
+                        break  # 缓存回放的响应不受 abort() 影响
+                    metrics.on_usage(delta.usage)
+                    metrics.on_delta(delta.reasoning, delta.content)
+                    if delta.reasoning:
+                        self.reasoning_parts.append(delta.reasoning)
+                    if delta.content:
+                        self.answer_parts.append(delta.content)
+                    if self.convo and time.monotonic() - last_checkpoint >= CHECKPOINT_INTERVAL:
+                        self.checkpoint()
+                        last_checkpoint = time.monotonic()
+            status = "cancelled" if self.cancelled.is_set() else "done"
         except Exception as e:
-            st.error(f"请求失败: {str(e)}")
-            return None
+            status = "cancelled" if self.cancelled.is_set() else "error"
+            if not self.cancelled.is_set():
+                self.error = str(e)  # 停止时关闭连接引发的读取异常不算错误，保留已生成的部分
+        if metrics is not None:
+            self.record = metrics.finish("ok" if status == "done" else status)
+        if self.convo:
+            self.persist()
+        self.finished = time.time()
+        self.status = status  # 最后更新状态，页面看到结束时回答已经落盘
+
+    def checkpoint(self):
+        """把已生成的部分写入对话旁的检查点文件，进程意外退出后可在加载时恢复"""
+        try:
+            with self.namer.lock:
+                filename = self.namer.resolve(self.convo)
+                if not os.path.exists(os.path.join(self.namer.directory, filename)):
+                    return  # 对话已被删除
+                path = os.path.join(self.namer.directory, filename + PARTIAL_EXT)
+                ConversationStore.write(path, [self.to_message()])
+                if self.checkpoint_path not in (None, path) and os.path.exists(self.checkpoint_path):
+                    os.remove(self.checkpoint_path)  # 对话已在后台重命名
+                self.checkpoint_path = path
+        except Exception as e:
+            print(f"写入检查点失败: {str(e)}")
+
+    def persist(self):
+        """把最终回答追加到对话日志，并删除检查点"""
+        try:
+            with self.namer.lock:
+                filename = FileManager.append_message(
+                    self.convo, self.to_message(), self.position, self.namer, self.index)
+                self.saved = filename is not None
+                paths = {self.checkpoint_path}
+                if filename:
+                    paths.add(os.path.join(self.namer.directory, filename + PARTIAL_EXT))
+                for path in paths:
+                    if path and os.path.exists(path):
+                        os.remove(path)
+        except Exception as e:
+            print(f"保存回答失败: {str(e)}")
+
+    def to_message(self):
+        """转换为要保存的助手消息"""
+        reasoning = self.reasoning.strip()
+        if self.error:
+            reasoning = f"{reasoning}\n\n错误信息: {self.error}".lstrip()  # 已生成的推理与错误信息一并保留
+        message = {
+            "role": "assistant",
+            "content": self.answer if self.answer or not self.error else "响应生成失败",
+            "reasoning": reasoning,
+            "model": self.model
+        }
+        if self.report and self.report["trimmed"]:
+            message["context"] = self.report
+        if self.cancelled.is_set():
+            message["stopped"] = True
+        return message
+
+
+class GenerationRegistry:
+    """按会话登记后台生成任务，页面重跑后据此重新连接到进行中的生成"""
+
+    def __init__(self, retention=GENERATION_RETENTION):
+        self.retention = retention
+        self.lock = threading.Lock()
+        self.jobs = {}  # 会话 ID -> StreamJob
+
+    @staticmethod
+    @st.cache_resource
+    def shared():
+        """跨会话共享的任务登记表"""
+        return GenerationRegistry()
+
+    @staticmethod
+    def session_id():
+        ctx = get_script_run_ctx()
+        return ctx.session_id if ctx else "default"
+
+    def get(self, session_id):
+        with self.lock:
+            return self.jobs.get(session_id)
+
+    def put(self, session_id, job):
+        """登记任务，同时清理已关闭会话遗留的过期任务"""
+        now = time.time()
+        with self.lock:
+            for key, other in list(self.jobs.items()):
+                if other.finished and now - other.finished > self.retention:
+                    del self.jobs[key]
+            self.jobs[session_id] = job
+
+    def pop(self, session_id):
+        with self.lock:
+            return self.jobs.pop(session_id, None)
+
+    def active(self, filename):
+        """是否有任务仍在向该对话写入"""
+        with self.lock:
+            jobs = list(self.jobs.values())
+        namer = ConversationNamer.shared()
+        return any(job.running and job.convo and job.namer is namer and namer.resolve(job.convo) == filename
+                   for job in jobs)
+
+
+class StreamRenderer:
+    """增量流式渲染：已完成的段落和代码块冻结为独立元素，只重绘未完成的尾部"""
+
+    FENCE_RE = re.compile(r" {0,3}(`{3,}|~{3,})")
+
+    def __init__(self, container, cursor="▌", interval=RENDER_INTERVAL,
+                 max_pending=RENDER_MAX_PENDING, clock=time.perf_counter):
+        self.container = container
+        self.cursor = cursor
+        self.interval = interval
+        self.max_pending = max_pending
+        self.clock = clock
+        self.frozen = []        # 已冻结的文本段
+        self.tail = ""          # 尚未冻结的尾部文本
+        self.pending = []       # 尚未重绘的增量
+        self.pending_len = 0
+        self.last_paint = 0.0
+        self.repaints = 0
+        self.painted_chars = 0
+        self.placeholder = container.empty()
+
+    @property
+    def text(self):
+        """当前累积的完整文本"""
+        return "".join(self.frozen) + self.tail + "".join(self.pending)
+
+    def feed(self, delta: str):
+        """追加增量，按时间和长度预算合并重绘"""
+        if not delta:
+            return
+        self.pending.append(delta)
+        self.pending_len += len(delta)
+        now = self.clock()
+        if now - self.last_paint >= self.interval or self.pending_len >= self.max_pending:
+            self.flush(now)
+
+    def flush(self, now=None, final=False):
+        """冻结已完成的段落并重绘尾部"""
+        if self.pending:
+            self.tail += "".join(self.pending)
+            self.pending.clear()
+            self.pending_len = 0
+
+        cut = len(self.tail) if final else StreamRenderer.split_point(self.tail)
+        if cut:
+            segment, self.tail = self.tail[:cut], self.tail[cut:]
+            self._paint(segment)
+            self.frozen.append(segment)
+            self.placeholder = self.container.empty()
+        if self.tail or not final:
+            self._paint(self.tail if final else self.tail + self.cursor)
+        self.last_paint = self.clock() if now is None else now
+
+    def finish(self):
+        """流结束：去掉光标并冻结剩余内容"""
+        self.flush(final=True)
+        return self.text
+
+    def _paint(self, text):
+        self.placeholder.markdown(UIManager.normalize_latex(text))
+        self.repaints += 1
+        self.painted_chars += len(text)
+
+    @staticmethod
+    def split_point(text: str) -> int:
+        """返回可安全冻结的位置：代码块/公式块之外的空行之后，且下一行不是缩进续行"""
+        pos = 0
+        cut = 0
+        fence = None
+        in_math = False
+        lines = text.split("\n")
+        for i, line in enumerate(lines[:-1]):  # 最后一行尚未结束
+            pos += len(line) + 1
+            stripped = line.strip()
+            match = StreamRenderer.FENCE_RE.match(line)
+            if fence:
+                if match and stripped == match.group(1)[0] * len(stripped) and len(stripped) >= len(fence):
+                    fence = None
+                    cut = pos
+                continue
+            if match:
+                fence = match.group(1)
+                continue
+            if line.count("$$") % 2:
+                in_math = not in_math
+                continue
+            if in_math or stripped:
+                continue
+            following = lines[i + 1]
+            if following and not following[0].isspace():
+                cut = pos
+        return cut
+
+
+class RenderCache:
+    """历史消息渲染缓存：按消息内容哈希保存预处理结果，按占用字节数LRU淘汰"""
+
+    def __init__(self, max_bytes=RENDER_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()   # 哈希 -> (渲染指令, 字节数)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    @st.cache_resource
+    def shared():
+        """跨会话共享的渲染缓存"""
+        return RenderCache()
+
+    @staticmethod
+    def key(msg):
+        return hashlib.sha256(json.dumps(msg, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def sizeof(ops):
+        total = 0
+        for _, value in ops:
+            if isinstance(value, list):
+                total += sum(len(text) + len(source or "") for text, source in value)
+            else:
+                total += len(value)
+        return total
+
+    def get(self, msg):
+        key = RenderCache.key(msg)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key][0]
+        ops = UIManager.prepare_message(msg)
+        size = RenderCache.sizeof(ops)
+        with self.lock:
+            if key not in self.entries and size <= self.max_bytes:
+                self.entries[key] = (ops, size)
+                self.size += size
+                while self.size > self.max_bytes:
+                    _, (_, evicted) = self.entries.popitem(last=False)
+                    self.size -= evicted
+        return ops
 
 
 class UIManager:
     """管理UI相关操作的类"""
 
     @staticmethod
-    def render_with_latex(text: str):
-        """渲染包含LaTeX的文本"""
+    def normalize_latex(text: str) -> str:
+        """规范化LaTeX定界符"""
         text = text.replace(r'\\', r"\\")
         text = text.replace(r'$', r"$")
         text = text.replace(r'$', r"$")
         text = text.replace(r'$$', r"$$")
         text = text.replace(r'$$', r"$$")
-        st.markdown(text)
+        return text
+
+    @staticmethod
+    def render_with_latex(text: str):
+        """渲染包含LaTeX的文本"""
+        st.markdown(UIManager.normalize_latex(text))
 
     @staticmethod
     def display_message(msg):
-        """显示消息"""
+        """显示消息（预处理结果来自渲染缓存）"""
         avatar = "🧑" if msg["role"] == "user" else "🤖"
         with st.chat_message(msg["role"], avatar=avatar):
-            # 先显示推理内容（如果有）
-            if msg["role"] == "assistant" and msg.get("reasoning"):
-                with st.expander("🧠 推理过程（点击展开）"):
-                    UIManager.render_with_latex(msg["reasoning"])
+            for kind, value in RenderCache.shared().get(msg):
+                if kind == "reasoning":
+                    with st.expander("🧠 推理过程（点击展开）"):
+                        st.markdown(value)
+                elif kind == "image":
+                    try:
+                        st.image(value, use_container_width=True)
+                    except:
+                        st.error("图片加载失败")
+                elif kind == "markdown":
+                    st.markdown(value)
+                elif kind == "references":
+                    with st.expander("📚 参考来源（点击展开）"):
+                        for i, (text, source) in enumerate(value):
+                            st.caption(f"参考资料 {i + 1}")
+                            st.markdown(text)
+                            if source:
+                                st.caption(source)
+                elif kind == "caption":
+                    st.caption(value)
+                elif kind == "error":
+                    st.error(value)
 
-            # 再显示消息内容
-            if isinstance(msg["content"], list):
-                for item in msg["content"]:
-                    if item["type"] == "image_url":
-                        try:
-                            base64_str = item["image_url"]["url"].split(",")[1]
-                            st.image(base64.b64decode(base64_str), use_container_width=True)
-                        except:
-                            st.error("图片加载失败")
-                    elif item["type"] == "text" and item["text"].strip():
-                        UIManager.render_with_latex(item["text"])
-                    elif item["type"] == "reference":
-                        with st.expander("📚 参考来源（点击展开）"):
-                            for i, ref in enumerate(item["reference"]):
-                                st.caption(f"参考资料 {i + 1}")
-                                UIManager.render_with_latex(f"```\n{ref['content']}\n```")
-                                if 'title' and 'link' in ref:
-                                    st.caption(f"{ref['title']}\n{ref['link']}")
-            else:
-                UIManager.render_with_latex(msg["content"])
+    @staticmethod
+    def prepare_message(msg):
+        """将消息预处理为渲染指令列表：先推理内容，再消息内容"""
+        ops = []
+        if msg["role"] == "assistant" and msg.get("reasoning"):
+            ops.append(("reasoning", UIManager.normalize_latex(msg["reasoning"])))
+
+        if isinstance(msg["content"], list):
+            for item in msg["content"]:
+                if item["type"] == "image_url":
+                    try:
+                        ops.append(("image", BlobStore.source(item["image_url"])))
+                    except:
+                        ops.append(("error", "图片加载失败"))
+                elif item["type"] == "text" and item["text"].strip():
+                    ops.append(("markdown", UIManager.normalize_latex(item["text"])))
+                elif item["type"] == "reference":
+                    ops.append(("references", [
+                        (UIManager.normalize_latex(f"```\n{ref['content']}\n```"),
+                         f"{ref['title']}\n{ref['link']}" if 'title' in ref and 'link' in ref else None)
+                        for ref in item["reference"]
+                    ]))
+        else:
+            ops.append(("markdown", UIManager.normalize_latex(msg["content"])))
+
+        if msg.get("context"):
+            ops.append(("caption", UIManager.describe_context(msg["context"])))
+        if msg.get("interrupted"):
+            ops.append(("caption", "⚠️ 生成意外中断，以上为恢复的部分输出"))
+        elif msg.get("stopped"):
+            ops.append(("caption", "⏹ 已停止生成"))
+        return ops
+
+    @staticmethod
+    def describe_context(report):
+        """上下文裁剪情况的简短说明"""
+        parts = [f"{report[field]} {label}" for field, label in (
+            ("dropped_messages", "条早期消息"), ("dropped_images", "张图片"), ("dropped_references", "组参考资料")
+        ) if report[field]]
+        text = f"上下文已裁剪（约 {report['before']} → {report['after']} tokens）：省略 " + "、".join(parts)
+        return text + "，已用摘要代替" if report["summarized"] else text
 
     @staticmethod
     def render_sidebar():
         """渲染侧边栏"""
         st.title("对话管理")
 
+        if MULTI_USER:
+            UIManager.render_user()
+
         # 模型设置区域
         st.subheader("模型设置")
         st.session_state.selected_model = st.selectbox(
             "选择对话模型",
-            ["deepseek-ai/DeepSeek-V3.1",
-             "Qwen/Qwen3-235B-A22B-Thinking-2507",
-             "zai-org/GLM-4.5",
-             "Pro/deepseek-ai/DeepSeek-V3.1"],
+            CHAT_MODELS,
             index=0
         )
+        st.session_state.fanout = st.toggle(
+            "多模型对比",
+            value=st.session_state.fanout,
+            help="同时向多个模型发送同一问题，并排显示，选择一个回答保存到对话中"
+        )
+        if st.session_state.fanout:
+            st.session_state.fanout_models = st.multiselect(
+                "对比模型",
+                CHAT_MODELS,
+                default=st.session_state.fanout_models
+            )
 
         # 参数调节部分
         col1, col2 = st.columns([3, 1])
@@ -313,30 +2563,232 @@ class UIManager:
                 format="%.2f"
             )
 
+        st.session_state.context_summary = st.toggle(
+            "超长对话自动摘要",
+            value=st.session_state.context_summary,
+            help="超出上下文预算而被省略的早期消息，用命名模型生成的摘要代替"
+        )
+        st.session_state.preprocess_images = st.toggle(
+            "压缩上传图片",
+            value=st.session_state.preprocess_images,
+            help=f"缩放至最长边 {IMAGE_MAX_SIDE.get(VLM_MODEL, DEFAULT_IMAGE_MAX_SIDE)} 像素、去除EXIF并重新压缩，重复图片只上传一次"
+        )
+
+        st.session_state.response_cache = st.toggle(
+            "响应缓存",
+            value=st.session_state.response_cache,
+            help="相同请求直接回放已保存的结果；默认只缓存 temperature 为 0 的请求"
+        )
+        if st.session_state.response_cache:
+            st.session_state.force_cache = st.checkbox(
+                "强制缓存（忽略 temperature）",
+                value=st.session_state.force_cache
+            )
+            stats = ResponseCache.shared().stats()
+            st.caption(f"缓存命中率 {stats['hit_rate']:.0%}（命中 {stats.get('hits', 0)} / "
+                       f"未命中 {stats.get('misses', 0)} / 跳过 {stats.get('bypass', 0)}），"
+                       f"{stats['entries']} 条，{stats['bytes'] / 1024 / 1024:.1f} MB")
+        st.session_state.show_metrics = st.toggle("显示性能统计", value=st.session_state.show_metrics)
+        if st.session_state.show_metrics:
+            UIManager.render_metrics()
+
         if st.button("➕ 新建对话", use_container_width=True):
             FileManager.new_conversation()
             st.rerun()
 
         st.subheader("历史对话")
+        query = st.text_input("🔍 搜索对话", key="search_query", placeholder="搜索消息、推理过程与参考资料")
+        if query:
+            UIManager.render_search(query)
+        st.session_state.local_naming = st.toggle(
+            "本地命名（不调用模型）",
+            value=st.session_state.local_naming,
+            help="使用提问首行作为对话标题，不额外发起网络请求"
+        )
         FileManager.refresh_convo_list()
-        convo_render_list = st.session_state.convo_list[:st.session_state.num_convo_display]
-        for convo in convo_render_list:
+        for row in st.session_state.convo_list:
+            convo = row["id"]
             cols = st.columns([3, 1])
             with cols[0]:
-                if st.button(convo[:-5], key=f"btn_{convo}", use_container_width=True):
+                if st.button(os.path.splitext(convo)[0], key=f"btn_{convo}", use_container_width=True,
+                             help=f"{row['message_count']} 条消息 · {row['model'] or '未知模型'}"):
                     FileManager.load_conversation(convo)
                     st.rerun()
             with cols[1]:
                 if st.button("×", key=f"del_{convo}", type='primary'):
-                    os.remove(os.path.join(HISTORY_DIR, convo))
+                    FileManager.delete_conversation(convo)
                     if st.session_state.current_convo == convo:
                         FileManager.new_conversation()
                     st.rerun()
-        if st.session_state.num_convo_display < len(st.session_state.convo_list):
+        if st.session_state.num_convo_display < st.session_state.convo_total:
             if st.button("加载更多...", key="load_more_convo"):
                 st.session_state.num_convo_display += 10
                 st.rerun()
 
+    @staticmethod
+    def render_user():
+        """当前用户、个人 API 密钥与配额用量"""
+        tenant = Tenant.current()
+        st.caption(f"👤 当前用户：{tenant.name}")
+        api_key = st.text_input(
+            "个人 API 密钥（可选）",
+            value=st.session_state.api_key,
+            type="password",
+            help="设置后请求使用自己的密钥，配额按密钥单独计算；只保存在本次会话中"
+        )
+        if api_key != st.session_state.api_key:
+            st.session_state.api_key = api_key
+            st.rerun()
+        ledger = UsageLedger.shared()
+        usage = ledger.usage(tenant)
+        st.caption(f"近 1 小时 {usage['requests']}"
+                   f"{f'/{ledger.requests_per_hour}' if ledger.requests_per_hour else ''} 次请求 · "
+                   f"近 24 小时 {usage['tokens']}"
+                   f"{f'/{ledger.tokens_per_day}' if ledger.tokens_per_day else ''} tokens")
+        if not st.context.headers.get(USER_HEADER) and st.button("切换用户", key="switch_user"):
+            st.session_state.user_name = ""
+            st.rerun()
+
+    @staticmethod
+    def render_search(query):
+        """显示全文搜索结果，点击打开对应对话并展开到命中的消息"""
+        hits = ConversationIndex.shared().search(query)
+        if not hits:
+            st.caption("没有找到匹配的消息")
+        roles = {"user": "🧑", "assistant": "🤖"}
+        kinds = {"text": "正文", "reasoning": "推理", "reference": "参考资料"}
+        for i, hit in enumerate(hits):
+            if st.button(os.path.splitext(hit["convo"])[0], key=f"hit_{i}", use_container_width=True):
+                FileManager.load_conversation(hit["convo"])
+                FileManager.reveal(hit["position"])
+                st.rerun()
+            st.caption(f"{roles.get(hit['role'], hit['role'])} {kinds.get(hit['kind'], hit['kind'])}："
+                       f"{hit['snippet']}")
+        st.divider()
+
+    @staticmethod
+    def render_metrics():
+        """按模型显示最近请求的 p50/p95 延迟与吞吐"""
+        rows = MetricsStore.shared().summary()
+        if not rows:
+            st.caption("暂无请求记录")
+            return
+        st.dataframe([{
+            "模型": row["model"],
+            "请求": row["requests"],
+            "失败": row["errors"],
+            "首字 p50/p95 (ms)": f"{row['ttft_ms_p50']} / {row['ttft_ms_p95']}",
+            "总耗时 p50/p95 (ms)": f"{row['total_ms_p50']} / {row['total_ms_p95']}",
+            "tokens/s p50": row["tokens_per_s_p50"],
+            "建连 p50 (ms)": row["connect_ms_p50"],
+        } for row in rows], hide_index=True)
+        if MULTI_USER:
+            stats = HttpTransport.shared().scheduler.stats()
+            st.caption(f"共享请求名额 {stats['active']}/{API_WORKERS} 使用中，"
+                       f"{stats['waiting']} 个请求排队（{stats['tenants']} 位用户）")
+            st.dataframe([{
+                "用户": row["tenant"],
+                "请求": row["requests"],
+                "失败": row["errors"],
+                "输入 tokens": row["prompt_tokens"],
+                "输出 tokens": row["completion_tokens"],
+            } for row in UsageLedger.shared().summary(time.time() - 86400)], hide_index=True)
+
+    @staticmethod
+    def clear_fanout():
+        """取消并清除多模型对比任务"""
+        for job in st.session_state.get('fanout_jobs', {}).values():
+            job.cancel()
+        st.session_state.fanout_jobs = {}
+
+    @staticmethod
+    def render_fanout():
+        """并排显示多模型对比的流式输出，全部结束后选择一个回答保存"""
+        jobs = st.session_state.fanout_jobs
+        views = {}
+        for column, (model, job) in zip(st.columns(len(jobs)), jobs.items()):
+            with column:
+                st.markdown(f"**{model}**")
+                if job.running and st.button("⏹ 停止", key=f"stop_{model}"):
+                    job.cancel()
+                views[model] = dict(UIManager.job_view("🤔 推理"), status=st.empty(), choose=st.empty())
+
+        finished = set()
+        while True:
+            for model, job in jobs.items():
+                if model in finished:
+                    continue
+                running = job.running  # 先读状态再取缓冲区，避免漏掉最后的增量
+                UIManager.pump_job(job, views[model])
+                if not running:
+                    finished.add(model)
+                    views[model]["answer"].finish()
+                    if views[model]["reasoning"]:
+                        views[model]["reasoning"].finish()
+                    views[model]["status"].caption(UIManager.describe_job(job))
+                else:
+                    views[model]["status"].caption("生成中...")
+            if len(finished) == len(jobs):
+                break
+            time.sleep(RENDER_INTERVAL)
+
+        for model, job in jobs.items():
+            if job.status == "error":
+                views[model]["choose"].error(f"请求失败: {job.error}")
+            elif views[model]["choose"].button("✅ 采用此回答", key=f"choose_{model}"):
+                message = job.to_message()
+                message["fanout"] = [{"model": other.model, "status": other.status, **{
+                    key: (other.record or {}).get(key)
+                    for key in ("ttft_ms", "total_ms", "prompt_tokens", "completion_tokens", "tokens_per_s")
+                }} for other in jobs.values()]
+                st.session_state.messages.append(message)
+                st.session_state.fanout_jobs = {}
+                FileManager.save_conversation()
+                st.rerun()
+        if st.button("放弃本次对比", key="discard_fanout"):
+            UIManager.clear_fanout()
+            st.rerun()
+
+    @staticmethod
+    def job_view(label):
+        """在当前容器中放置任务输出的占位元素"""
+        return {
+            "label": label,
+            "reasoning_box": st.empty(),
+            "reasoning": None,
+            "answer": StreamRenderer(st.container()),
+            "seen": [0, 0]
+        }
+
+    @staticmethod
+    def pump_job(job, view):
+        """把任务缓冲区中的新增内容交给渲染器；每次重跑都从头重放已生成的部分"""
+        reasoning_seen, answer_seen = view["seen"]
+        reasoning = job.reasoning_parts[reasoning_seen:]
+        answer = job.answer_parts[answer_seen:]
+        view["seen"] = [reasoning_seen + len(reasoning), answer_seen + len(answer)]
+        text = "".join(reasoning)
+        if view["reasoning"] is None and text.strip():  # 推理开头的空白不单独显示
+            view["reasoning"] = StreamRenderer(view["reasoning_box"].expander(view["label"]), cursor="")
+        if view["reasoning"] is not None and text:
+            view["reasoning"].feed(text)
+        if answer:
+            view["answer"].feed("".join(answer))
+
+    @staticmethod
+    def describe_job(job):
+        """任务状态、延迟与用量的简短说明"""
+        labels = {"done": "完成", "cancelled": "已停止", "error": "失败"}
+        record = job.record or {}
+        parts = [labels.get(job.status, job.status)]
+        if record.get("ttft_ms") is not None:
+            parts.append(f"首字 {record['ttft_ms']:.0f} ms")
+        if record.get("total_ms") is not None:
+            parts.append(f"总耗时 {record['total_ms'] / 1000:.1f} s")
+        if record.get("completion_tokens"):
+            parts.append(f"{record['completion_tokens']} tokens")
+        return " · ".join(parts)
+
     @staticmethod
     def process_user_input():
         """处理用户输入"""
@@ -348,21 +2800,26 @@ class UIManager:
         )
 
         if prompt := st.chat_input("请输入您的问题或描述..."):
+            # 超出配额时不发送
+            tenant = Tenant.current()
+            if reason := UsageLedger.shared().exceeded(tenant):
+                st.error(reason)
+                return
+
             # 构建多模态消息内容
             message_content = []
 
             # 处理上传的图片
-            for uploaded_file in uploaded_files:
-                if uploaded_file:
-                    base64_str = base64.b64encode(uploaded_file.read()).decode("utf-8")
-                    mime_type = uploaded_file.type
-                    message_content.append({
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:{mime_type};base64,{base64_str}"
-                        }
-                    })
-                    uploaded_file.seek(0)  # 重置文件指针
+            images = [(f.getvalue(), f.type) for f in uploaded_files if f]
+            image_stats = None
+            if images and st.session_state.preprocess_images:
+                images, image_stats = ImagePreprocessor.run(images)
+                print(f"图片预处理：{image_stats}")
+            for data, mime_type in images:
+                message_content.append({
+                    "type": "image_url",
+                    "image_url": BlobStore.put(data, mime_type)
+                })
 
             # 处理文本输入
             if prompt.strip():
@@ -378,17 +2835,16 @@ class UIManager:
             }
             st.session_state.messages.append(user_message)
 
-            # 显示用户消息
-            with st.chat_message("user", avatar="🧑"):
-                for item in message_content:
-                    if item["type"] == "image_url":
-                        try:
-                            base64_str = item["image_url"]["url"].split(",")[1]
-                            st.image(base64.b64decode(base64_str), use_container_width=True)
-                        except:
-                            st.error("图片显示失败")
-                    elif item["type"] == "text":
-                        UIManager.render_with_latex(item["text"])
+            # 新对话先以临时文件名保存，标题在后台生成
+            if not st.session_state.current_convo:
+                st.session_state.current_convo = ConversationNamer.provisional_name()
+                FileManager.save_conversation()
+                ConversationNamer.shared().submit(
+                    st.session_state.current_convo, prompt.strip(), local=st.session_state.local_naming,
+                    cache=ResponseCache.mode(), config=ApiConfig.from_session(), tenant=tenant)
+
+            # 用户消息在重跑后随聊天记录显示，预处理统计显示在其下方
+            st.session_state.image_stats = image_stats
 
             # 自动选择模型
             use_vlm = any(
@@ -397,81 +2853,95 @@ class UIManager:
                 for msg in st.session_state.messages[-1:]
             )
 
-            # 准备API请求
-            try:
-                with st.chat_message("assistant", avatar="🤖️"):
-                    reasoning_placeholder = st.empty()
-                    answer_placeholder = st.empty()
-                    full_reasoning = ""
-                    full_answer = ""
-
-                    # 发送API请求
-                    model = VLM_MODEL if use_vlm else st.session_state.selected_model
-                    response = ApiManager.send_request(model, st.session_state.messages, use_vlm)
-
-                    if response is None:
-                        return
-
-                    # 处理流式响应
-                    for chunk in response.iter_lines():
-                        if chunk:
-                            chunk_str = chunk.decode('utf-8').replace('data: ', '')
-                            if chunk_str != "[DONE]":
-                                try:
-                                    chunk_data = json.loads(chunk_str)
-                                except json.JSONDecodeError:
-                                    continue
-                                delta = chunk_data.get('choices', [{}])[0].get('delta', {})
-                                content = delta.get('content', '')
-                                reasoning_content = delta.get('reasoning_content', '')
-                                if content:
-                                    full_answer += content
-                                    with answer_placeholder:
-                                        UIManager.render_with_latex(full_answer + "▌")
-                                if reasoning_content:
-                                    full_reasoning += reasoning_content
-                                    if full_reasoning.strip():
-                                        with reasoning_placeholder.expander("🤔 实时推理"):
-                                            UIManager.render_with_latex(full_reasoning)
-                    print("响应接受完成。")
-
-                    # 保存最终响应
-                    with reasoning_placeholder:
-                        if full_reasoning.strip():
-                            with st.expander("🧠 推理过程"):
-                                UIManager.render_with_latex(full_reasoning.strip())
-                    with answer_placeholder:
-                        UIManager.render_with_latex(full_answer)
-                    st.session_state.messages.append({
-                        "role": "assistant",
-                        "content": full_answer,
-                        "reasoning": full_reasoning.strip()
-                    })
+            # 先保存用户消息，回答由后台任务生成并追加到对话日志；较早的消息按上下文预算读入
+            FileManager.save_conversation()
+            config = ApiConfig.from_session()
+            FileManager.load_context(
+                VLM_MODEL if use_vlm else st.session_state.selected_model, config, use_vlm)
 
+            # 多模型对比：每个模型一个后台任务，页面重跑后继续显示
+            if st.session_state.fanout and not use_vlm and len(st.session_state.fanout_models) > 1:
+                for model in st.session_state.fanout_models:
+                    payload, report = ApiManager.build_request(
+                        model, st.session_state.messages, config=config, cache=ResponseCache.mode(), tenant=tenant)
+                    st.session_state.fanout_jobs[model] = StreamJob(payload, report).start()
+                st.rerun()
+
+            model = VLM_MODEL if use_vlm else st.session_state.selected_model
+            try:
+                payload, st.session_state.last_context = ApiManager.build_request(
+                    model, st.session_state.messages, use_vlm, config, ResponseCache.mode(), tenant)
             except Exception as e:
                 st.error(f"请求失败: {str(e)}")
-                st.session_state.messages.append({
-                    "role": "assistant",
-                    "content": "响应生成失败",
-                    "reasoning": f"错误信息: {str(e)}"
-                })
+                return
+            job = StreamJob(payload, st.session_state.last_context, convo=st.session_state.current_convo,
+                            position=st.session_state.message_offset + len(st.session_state.messages))
+            GenerationRegistry.shared().put(GenerationRegistry.session_id(), job.start())
+            FileManager.refresh_convo_list()
+            st.rerun()
 
-            # 生成文件名（优先使用文本内容）
-            filename_content = prompt.strip()
-            if not st.session_state.current_convo:
-                print("正在生成对话文件名...")
-                st.session_state.current_convo = FileManager.generate_filename(filename_content)
-            # 保存对话记录
-            if st.session_state.current_convo:
-                FileManager.save_conversation()
-                FileManager.refresh_convo_list()
-            print("\n")
+    @staticmethod
+    def sync_generation():
+        """返回本会话的后台生成任务；任务已结束时把回答并入当前对话并注销任务"""
+        registry = GenerationRegistry.shared()
+        session_id = GenerationRegistry.session_id()
+        job = registry.get(session_id)
+        if job is None or job.running:
+            return job
+        registry.pop(session_id)
+        print(f"后台生成结束：{UIManager.describe_job(job)}")
+        # 回答已由任务写入日志；当前仍在该对话且尚未重新加载时，补到内存中的消息列表
+        current = st.session_state.current_convo
+        loaded = job.position - st.session_state.message_offset
+        if current and ConversationNamer.shared().resolve(job.convo) == current \
+                and len(st.session_state.messages) == loaded:
+            st.session_state.messages.append(job.to_message())
+            if job.saved and st.session_state.saved_count == loaded:
+                st.session_state.saved_count += 1
+                FileManager.trim_loaded()
+        if job.status == "error":
+            st.session_state.generation_error = job.error
+        FileManager.refresh_convo_list()
+        return None
+
+    @staticmethod
+    def render_generation(job):
+        """从任务缓冲区渲染进行中的回答；页面重跑不会中断生成，结束后重跑以显示保存的消息"""
+        filename = ConversationNamer.shared().resolve(job.convo)
+        view = None
+        if filename != st.session_state.current_convo:
+            # 正在浏览其他对话：只显示进度，不渲染内容
+            st.info(f"对话「{ConversationIndex.title_of(filename)}」正在后台生成回答，完成后会自动保存。")
+            if st.button("⏹ 停止生成", key="stop_generation"):
+                job.cancel()
+            status = st.empty()
+        else:
+            with st.chat_message("assistant", avatar="🤖️"):
+                if st.button("⏹ 停止生成", key="stop_generation"):
+                    job.cancel()
+                status = st.empty()
+                view = UIManager.job_view("🤔 实时推理")
+        # 每轮都更新状态元素，页面交互引起的重跑可以在此处打断循环
+        while True:
+            running = job.running  # 先读状态再取缓冲区，避免漏掉最后的增量
+            if view is not None:
+                UIManager.pump_job(job, view)
+            if not running:
+                break
+            status.caption("正在停止..." if job.cancelled.is_set() else "生成中...")
+            time.sleep(RENDER_INTERVAL)
+        print("响应接受完成。")
+        st.rerun()
 
 
 def main():
     """主函数"""
     # 初始化会话
     SessionManager.init_session()
+    SessionManager.identify()
+
+    # 后台生成任务：已结束的回答并入对话，进行中的在下方继续显示
+    job = UIManager.sync_generation()
 
     # 侧边栏布局
     with st.sidebar:
@@ -479,13 +2949,41 @@ def main():
 
     # 主界面布局
     st.title("智能对话助手（支持图文）")
+    if error := st.session_state.pop('generation_error', None):
+        st.error(f"请求失败: {error}")
 
-    # 显示聊天记录（支持多模态）
-    for msg in st.session_state.messages:
+    # 显示聊天记录（支持多模态），较早的消息折叠
+    # 较早的消息可能尚未从文件读入，展开时按页加载
+    hidden = max(len(st.session_state.messages) - st.session_state.history_window, 0)
+    if hidden or st.session_state.message_offset:
+        if st.button(f"⬆️ 显示更早的消息（还有 {hidden + st.session_state.message_offset} 条）", key="show_earlier"):
+            st.session_state.history_window += HISTORY_WINDOW
+            if st.session_state.history_window > len(st.session_state.messages):
+                FileManager.load_earlier(
+                    max(st.session_state.history_window - len(st.session_state.messages), LOAD_PAGE))
+            st.rerun()
+        if (loaded := FileManager.loaded_bytes()) is not None:
+            st.caption(f"已加载 {len(st.session_state.messages)}/"
+                       f"{st.session_state.message_offset + len(st.session_state.messages)} 条消息，"
+                       f"约 {loaded / 1024:.0f} KB")
+    for msg in st.session_state.messages[hidden:]:
         UIManager.display_message(msg)
+    if image_stats := st.session_state.image_stats:
+        saved = image_stats["original_bytes"] - image_stats["processed_bytes"]
+        st.caption(
+            f"图片预处理：{image_stats['images']} 张，"
+            f"{image_stats['original_bytes'] / 1024:.0f} KB → {image_stats['processed_bytes'] / 1024:.0f} KB，"
+            f"节省 {saved / 1024:.0f} KB，跳过重复 {image_stats['duplicates']} 张"
+        )
 
-    # 处理用户输入
-    UIManager.process_user_input()
+    # 多模型对比或后台生成进行中时，暂不接受新的输入
+    if st.session_state.fanout_jobs:
+        UIManager.render_fanout()
+    elif job is not None:
+        st.chat_input("正在生成回答...", disabled=True)
+        UIManager.render_generation(job)
+    else:
+        UIManager.process_user_input()
 
     # 自动滚动和保存功能
     st.markdown("""
@@ -0,0 +1,362 @@
+"""对话历史的批量导出、导入与压缩整理
+
+用法：
+    python archive.py export [-o backup.jsonl.zst] [--user NAME] [--workers 4]
+    python archive.py import backup.jsonl.zst [--user NAME] [--workers 4]
+    python archive.py compact [--user NAME] [--workers 4]
+
+归档是压缩的 JSONL（安装 zstandard 时默认使用 zstd，否则使用 gzip）：首行为文件头，随后每张图片一条 blob 记录
+（同一图片只保存一次），每个对话一条 conversation 记录，末行为汇总。每条记录带 SHA-256 校验和，导入时逐条校验，
+缺少汇总行说明归档不完整。
+compact 把旧的整体 JSON 文件改写为日志格式，把内嵌的 base64 图片移入图片存储，并报告节省的空间。
+import 与 compact 会修改历史目录，请在界面未运行时执行。
+"""
+import argparse
+import base64
+import binascii
+import gzip
+import hashlib
+import json
+import os
+import sys
+import time
+import zlib
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
+
+try:  # 可选的 zstd 压缩，未安装时使用 gzip
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from GUI import HISTORY_DIR, HISTORY_EXT, LEGACY_EXT, BlobStore, ConversationIndex, ConversationStore, Tenant
+
+ARCHIVE_VERSION = 1
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+ZSTD_LEVEL = 10
+# 截断或损坏的归档在解压与解析时可能抛出的异常
+READ_ERRORS = (EOFError, OSError, ValueError, zlib.error) + ((zstandard.ZstdError,) if zstandard else ())
+
+
+def checksum(data: bytes):
+    return hashlib.sha256(data).hexdigest()
+
+
+def file_checksum(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def ordered_map(executor, fn, items, window):
+    """并行执行并按输入顺序产出结果；最多 window 个任务在途，不会一次读入全部对话"""
+    pending = deque()
+    for item in items:
+        if len(pending) >= window:
+            yield pending.popleft().result()
+        pending.append(executor.submit(fn, item))
+    while pending:
+        yield pending.popleft().result()
+
+
+def read_records(f, errors):
+    """逐条产出归档记录；归档截断或损坏时停止，并把原因追加到 errors"""
+    try:
+        for line in f:
+            record = json.loads(line)
+            if not isinstance(record, dict) or "type" not in record:
+                raise ValueError("记录格式错误")
+            yield record
+    except READ_ERRORS as e:
+        errors.append(e)
+
+
+def open_archive(path, mode):
+    """以文本方式打开归档：写入时按扩展名选择压缩格式，读取时按文件头识别"""
+    if mode == "w":
+        zstd = path.endswith(".zst")
+    else:
+        with open(path, 'rb') as f:
+            zstd = f.read(4) == ZSTD_MAGIC
+    if not zstd:
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    if zstandard is None:
+        raise SystemExit("zstd 归档需要安装 zstandard：pip install zstandard")
+    if mode == "w":
+        cctx = zstandard.ZstdCompressor(level=ZSTD_LEVEL, threads=-1, write_checksum=True)
+        return zstandard.open(path, "wt", cctx=cctx, encoding="utf-8")
+    return zstandard.open(path, "rt", encoding="utf-8")
+
+
+def externalize(messages, store=False):
+    """把消息中内嵌的 base64 图片换成图片存储引用（原地修改）
+
+    返回 (消息用到的图片 {哈希: (MIME类型, 数据)}, 统计)；已是引用的图片数据为 None。
+    store 为 True 时把内嵌图片写入图片存储，否则只计算引用。
+    """
+    blobs = {}
+    stats = {"inlined": 0, "stored_bytes": 0}
+    for msg in messages:
+        if not isinstance(msg.get("content"), list):
+            continue
+        for item in msg["content"]:
+            if item.get("type") != "image_url":
+                continue
+            image_url = item["image_url"]
+            if "blob" in image_url:
+                blobs.setdefault(image_url["blob"], (image_url["mime"], None))
+                continue
+            header, _, encoded = image_url.get("url", "").partition(",")
+            if not header.startswith("data:") or not encoded:
+                continue  # 外部链接原样保留
+            try:
+                data = base64.b64decode(encoded)
+            except (binascii.Error, ValueError):
+                continue
+            mime = header[5:].split(";")[0] or "application/octet-stream"
+            ref = {"blob": checksum(data), "mime": mime}
+            if store:
+                if not os.path.exists(BlobStore.path(ref["blob"], mime)):
+                    stats["stored_bytes"] += len(data)
+                ref = BlobStore.put(data, mime)
+            item["image_url"] = ref
+            blobs[ref["blob"]] = (mime, data)
+            stats["inlined"] += 1
+    return blobs, stats
+
+
+def list_conversations(directory):
+    return sorted(f for f in os.listdir(directory) if f.endswith((HISTORY_EXT, LEGACY_EXT)))
+
+
+def write_record(out, record):
+    out.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n")
+
+
+def export_history(args):
+    directory = args.directory
+    stats = {"conversations": 0, "messages": 0, "blobs": 0, "blob_bytes": 0, "missing_blobs": 0, "damaged": 0}
+
+    def read(filename):
+        path = os.path.join(directory, filename)
+        messages, intact = ConversationStore.read(path)
+        blobs, _ = externalize(messages)
+        return filename, os.path.getmtime(path), intact, messages, blobs
+
+    emitted = set()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.workers) as executor, open_archive(args.output, "w") as out:
+        write_record(out, {"type": "header", "version": ARCHIVE_VERSION, "created": time.time(),
+                           "source": directory})
+        for filename, mtime, intact, messages, blobs in ordered_map(
+                executor, read, list_conversations(directory), args.workers * 2):
+            if not intact:
+                print(f"{filename} 含有残缺的记录，只导出可解析的消息")
+                stats["damaged"] += 1
+            # 图片记录写在首个引用它的对话之前，每张只写一次
+            for digest, (mime, data) in blobs.items():
+                if digest in emitted:
+                    continue
+                if data is None:
+                    try:
+                        with open(BlobStore.path(digest, mime), 'rb') as f:
+                            data = f.read()
+                    except OSError:
+                        print(f"{filename} 引用的图片 {digest} 不存在，已跳过")
+                        stats["missing_blobs"] += 1
+                        continue
+                write_record(out, {"type": "blob", "sha256": digest, "mime": mime,
+                                   "data": base64.b64encode(data).decode("ascii")})
+                emitted.add(digest)
+                stats["blobs"] += 1
+                stats["blob_bytes"] += len(data)
+            write_record(out, {"type": "conversation", "name": os.path.splitext(filename)[0] + HISTORY_EXT,
+                               "mtime": mtime, "count": len(messages),
+                               "sha256": checksum(ConversationStore.encode(messages)), "messages": messages})
+            stats["conversations"] += 1
+            stats["messages"] += len(messages)
+        write_record(out, {"type": "footer", "conversations": stats["conversations"], "blobs": stats["blobs"]})
+    stats["archive_bytes"] = os.path.getsize(args.output)
+    stats["seconds"] = round(time.perf_counter() - start, 2)
+    return stats
+
+
+def target_name(directory, name, digest, reserved):
+    """导入后的文件名：同名且内容相同时返回 None（跳过），内容不同时加序号"""
+    stem = os.path.splitext(os.path.basename(name))[0]  # 只取文件名，防止写到历史目录之外
+    target, n = stem + HISTORY_EXT, 1
+    while target in reserved or os.path.exists(os.path.join(directory, target)):
+        if target not in reserved and file_checksum(os.path.join(directory, target)) == digest:
+            return None
+        n += 1
+        target = f"{stem}({n}){HISTORY_EXT}"
+    reserved.add(target)
+    return target
+
+
+def import_history(args):
+    directory = args.directory
+    index = ConversationIndex(directory)  # 先打开索引，首次建立时只导入已有的文件
+    stats = {"conversations": 0, "skipped": 0, "blobs": 0, "checksum_errors": 0, "complete": False}
+    reserved = set()
+    pending = set()
+
+    def write_blob(record):
+        data = base64.b64decode(record["data"])
+        if checksum(data) != record["sha256"]:
+            return "blob", record["sha256"], None
+        BlobStore.put(data, record["mime"])
+        return "blob", record["sha256"], True
+
+    def write_conversation(target, record):
+        path = os.path.join(directory, target)
+        ConversationStore.write(path, record["messages"])
+        os.utime(path, (record["mtime"], record["mtime"]))
+        return "conversation", target, record
+
+    def collect(futures):
+        for future in futures:
+            kind, name, result = future.result()
+            if kind == "blob":
+                stats["blobs" if result else "checksum_errors"] += 1
+                if not result:
+                    print(f"图片 {name} 校验失败，已跳过")
+                continue
+            index.upsert(name, result["messages"], created=result["mtime"])
+            index.index_messages(name, result["messages"])
+            stats["conversations"] += 1
+
+    start = time.perf_counter()
+    counts = {"conversation": 0, "blob": 0}
+    errors = []
+    with ThreadPoolExecutor(max_workers=args.workers) as executor, open_archive(args.input, "r") as f:
+        try:
+            header = json.loads(f.readline() or "{}")
+        except READ_ERRORS:
+            header = {}
+        if header.get("type") != "header" or header.get("version") != ARCHIVE_VERSION:
+            raise SystemExit("不是有效的对话归档")
+        try:
+            for record in read_records(f, errors):
+                kind = record["type"]
+                if kind == "footer":
+                    stats["complete"] = record["conversations"] == counts["conversation"] \
+                        and record["blobs"] == counts["blob"]
+                    break
+                counts[kind] += 1
+                if kind == "blob":
+                    future = executor.submit(write_blob, record)
+                else:
+                    if checksum(ConversationStore.encode(record["messages"])) != record["sha256"]:
+                        print(f"对话 {record['name']} 校验失败，已跳过")
+                        stats["checksum_errors"] += 1
+                        continue
+                    target = target_name(directory, record["name"], record["sha256"], reserved)
+                    if target is None:
+                        stats["skipped"] += 1  # 已存在相同的对话
+                        continue
+                    future = executor.submit(write_conversation, target, record)
+                pending.add(future)
+                # 只保留有限的待写入记录，归档再大也不会一次读入内存
+                while len(pending) >= args.workers * 2:
+                    finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(finished)
+        finally:
+            # 无论归档是否读完，已写入的对话都要登记到索引中
+            finished, _ = wait(pending)
+            collect(finished)
+    if errors:
+        print(f"归档读取中断（{type(errors[0]).__name__}: {errors[0]}），已导入此前的完整记录")
+    if not stats["complete"]:
+        print("归档不完整：缺少结尾记录或记录数不符，可能在写入时被中断")
+    stats["seconds"] = round(time.perf_counter() - start, 2)
+    return stats
+
+
+def compact_history(args):
+    directory = args.directory
+    index = ConversationIndex(directory)
+    stats = {"files": 0, "rewritten": 0, "converted": 0, "images_externalized": 0,
+             "bytes_before": 0, "bytes_after": 0, "blob_bytes_added": 0}
+
+    def compact(filename):
+        path = os.path.join(directory, filename)
+        before = os.path.getsize(path)
+        messages, intact = ConversationStore.read(path)
+        _, image_stats = externalize(messages, store=True)
+        encoded = ConversationStore.encode(messages)
+        legacy = filename.endswith(LEGACY_EXT)
+        # 日志文件只有含内嵌图片、残缺记录或多余空白时才重写
+        if not legacy and intact and not image_stats["inlined"] and len(encoded) >= before:
+            return None
+        target = filename
+        if legacy:
+            stem, n = os.path.splitext(filename)[0], 1
+            target = stem + HISTORY_EXT
+            while os.path.exists(os.path.join(directory, target)):
+                n += 1
+                target = f"{stem}({n}){HISTORY_EXT}"
+        mtime = os.path.getmtime(path)
+        ConversationStore.write(os.path.join(directory, target), messages)
+        os.utime(os.path.join(directory, target), (mtime, mtime))
+        if legacy:
+            os.remove(path)
+        return filename, target, mtime, messages, before, len(encoded), image_stats
+
+    start = time.perf_counter()
+    filenames = list_conversations(directory)
+    stats["files"] = len(filenames)
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        for result in ordered_map(executor, compact, filenames, args.workers * 2):
+            if result is None:
+                continue
+            filename, target, mtime, messages, before, after, image_stats = result
+            if target != filename:
+                index.rename(filename, target)
+                stats["converted"] += 1
+            index.index_messages(target, messages)
+            index.upsert(target, messages, created=mtime)
+            stats["rewritten"] += 1
+            stats["images_externalized"] += image_stats["inlined"]
+            stats["bytes_before"] += before
+            stats["bytes_after"] += after
+            stats["blob_bytes_added"] += image_stats["stored_bytes"]
+    stats["bytes_reclaimed"] = stats["bytes_before"] - stats["bytes_after"] - stats["blob_bytes_added"]
+    stats["seconds"] = round(time.perf_counter() - start, 2)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="对话历史的导出、导入与压缩整理")
+    parser.add_argument("--user", help="多用户模式下的用户名（默认处理全局历史目录）")
+    parser.add_argument("--workers", type=int, default=4, help="并行读写的线程数")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("export", help="导出为单个压缩归档")
+    p.add_argument("-o", "--output", help="归档文件（.zst 或 .gz，默认按日期命名）")
+    p.set_defaults(func=export_history)
+
+    p = sub.add_parser("import", help="从归档导入，已存在的相同对话会被跳过")
+    p.add_argument("input", help="归档文件")
+    p.set_defaults(func=import_history)
+
+    p = sub.add_parser("compact", help="改写旧格式文件并移出内嵌图片")
+    p.set_defaults(func=compact_history)
+
+    args = parser.parse_args()
+    args.directory = Tenant(Tenant.clean_name(args.user)).directory if args.user else HISTORY_DIR
+    if args.command == "export" and not args.output:
+        ext = ".jsonl.zst" if zstandard is not None else ".jsonl.gz"
+        args.output = f"ChatHistory-{datetime.now():%Y%m%d-%H%M%S}{ext}"
+    os.makedirs(args.directory, exist_ok=True)
+    stats = args.func(args)
+    print(json.dumps(stats, ensure_ascii=False, indent=2))
+    if stats.get("checksum_errors") or stats.get("complete") is False:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
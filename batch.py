@@ -0,0 +1,185 @@
+"""批量评测：从 JSONL 读取提示词，并发调用模型，结果逐行写入 JSONL
+
+用法：
+    python batch.py prompts.jsonl [-o results.jsonl] [--model MODEL] [--concurrency 8] [--rate 5]
+                    [--max-tokens 2048] [--temperature 0] [--base-url URL] [--cache auto]
+
+输入每行一个对象：{"id": ..., "prompt": "..."}，或用 "messages" 给出完整的多轮消息；
+可选 "model"、"system" 字段覆盖命令行设置。缺少 id 时以行号为 id。
+输出文件中已成功的 id 会被跳过，因此中断后重新运行同一命令即可续跑；失败的条目会重试并追加新记录。
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from contextlib import redirect_stdout
+
+from GUI import CHAT_MODELS, POOL_SIZE, ApiConfig, ApiManager, HttpTransport, MetricsStore
+
+
+class RateLimiter:
+    """按固定间隔发放请求许可，rate 为每秒请求数（0 表示不限速）"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.next = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            slot = max(self.next, now)
+            self.next = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def load_prompts(path):
+    """逐行读取提示词，产出 (id, 条目)"""
+    with open(path, 'r', encoding='utf-8') as f:
+        for n, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            yield str(item.get("id", n)), item
+
+
+def load_done(path):
+    """已成功完成的 id；输出文件末尾被中断截断的行忽略"""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get("status") == "ok":
+                done.add(str(record["id"]))
+    return done
+
+
+def to_messages(item):
+    if "messages" in item:
+        return item["messages"]
+    messages = [{"role": "system", "content": item["system"]}] if item.get("system") else []
+    return messages + [{"role": "user", "content": item["prompt"]}]
+
+
+def run_item(item_id, item, args, config, transport, store, limiter):
+    """执行一条提示词，返回要写入的结果记录（不抛出异常）"""
+    model = item.get("model", args.model)
+    limiter.wait()
+    reasoning, answer = [], []
+    metrics = None
+    try:
+        payload, _ = ApiManager.build_request(model, to_messages(item), config=config, cache=args.cache)
+        response = ApiManager.open_stream(payload, transport, args.cache, url=args.base_url, store=store)
+        metrics = response.metrics
+        with response:
+            for delta in ApiManager.iter_stream(response):
+                metrics.on_usage(delta.usage)
+                metrics.on_delta(delta.reasoning, delta.content)
+                if delta.reasoning:
+                    reasoning.append(delta.reasoning)
+                if delta.content:
+                    answer.append(delta.content)
+        status, error = "ok", None
+    except Exception as e:
+        status, error = "error", str(e)
+    # open_stream 失败时已自行结束统计
+    record = metrics.finish(status) if metrics is not None else {}
+    return {
+        "id": item_id,
+        "model": model,
+        "status": status,
+        "content": "".join(answer),
+        "reasoning": "".join(reasoning).strip(),
+        "error": error,
+        **{key: record.get(key) for key in (
+            "ttft_ms", "total_ms", "prompt_tokens", "completion_tokens", "reasoning_tokens", "tokens_per_s")}
+    }
+
+
+def summarize(results, skipped, seconds):
+    """吞吐、延迟分位数与 token 用量汇总"""
+    ok = [r for r in results if r["status"] == "ok"]
+    summary = {
+        "items": len(results),
+        "skipped": skipped,
+        "ok": len(ok),
+        "errors": len(results) - len(ok),
+        "seconds": round(seconds, 2),
+        "requests_per_s": round(len(results) / seconds, 2) if seconds > 0 else None,
+        "prompt_tokens": sum(r["prompt_tokens"] or 0 for r in ok),
+        "completion_tokens": sum(r["completion_tokens"] or 0 for r in ok),
+    }
+    summary["completion_tokens_per_s"] = round(summary["completion_tokens"] / seconds, 2) if seconds > 0 else None
+    for field in ("ttft_ms", "total_ms", "tokens_per_s"):
+        values = [r[field] for r in ok if r[field] is not None]
+        for q in (0.5, 0.95, 0.99):
+            summary[f"{field}_p{round(q * 100)}"] = MetricsStore.quantile(values, q)
+    return summary
+
+
+def run(args):
+    config = ApiConfig(max_tokens=args.max_tokens, temperature=args.temperature, top_p=args.top_p)
+    # 批量任务独占一个传输对象：连接池与单模型并发上限都按 --concurrency 设置
+    transport = HttpTransport(pool_size=max(POOL_SIZE, args.concurrency), concurrency={},
+                              default_concurrency=args.concurrency)
+    store = MetricsStore()  # 指标照常写入指标文件，但不启动导出服务
+    limiter = RateLimiter(args.rate)
+    done = load_done(args.output)
+    results, skipped = [], 0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor, \
+            open(args.output, 'a', encoding='utf-8') as out:
+        pending = set()
+
+        def write(futures):
+            for future in futures:
+                result = future.result()
+                out.write(json.dumps(result, ensure_ascii=False) + "\n")
+                out.flush()  # 逐条落盘，中断后可续跑
+                results.append(result)
+
+        for item_id, item in load_prompts(args.input):
+            if item_id in done:
+                skipped += 1
+                continue
+            # 只保留有限的待执行任务，提示词文件再大也不会一次读入内存
+            while len(pending) >= args.concurrency * 2:
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                write(finished)
+            pending.add(executor.submit(run_item, item_id, item, args, config, transport, store, limiter))
+        write(as_completed(pending))
+    return summarize(results, skipped, time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="批量评测")
+    parser.add_argument("input", help="提示词 JSONL 文件")
+    parser.add_argument("-o", "--output", help="结果 JSONL 文件（默认与输入同名，后缀 .results.jsonl）")
+    parser.add_argument("--model", default=CHAT_MODELS[0], help="默认模型")
+    parser.add_argument("--concurrency", type=int, default=4, help="同时进行的请求数")
+    parser.add_argument("--rate", type=float, default=0.0, help="每秒最多发起的请求数（0 表示不限）")
+    parser.add_argument("--max-tokens", type=int, default=2048)
+    parser.add_argument("--temperature", type=float, default=1.0)
+    parser.add_argument("--top-p", type=float, default=1.0)
+    parser.add_argument("--base-url", help="接口地址（默认 SiliconFlow，可指向本地模拟端点）")
+    parser.add_argument("--cache", choices=["auto", "force"], help="使用响应缓存")
+    args = parser.parse_args()
+    args.output = args.output or os.path.splitext(args.input)[0] + ".results.jsonl"
+    with redirect_stdout(sys.stderr):  # 应用日志写到标准错误，标准输出只有汇总 JSON
+        summary = run(args)
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
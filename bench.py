@@ -0,0 +1,699 @@
+"""离线基准测试
+
+用法：
+    python bench.py render [--stream FILE] [--tokens 100000] [--rate 60]
+    python bench.py transport [--turns 20] [--ttft 0.05] [--fail 2]
+    python bench.py save [--lengths 10,100,500] [--image-kb 200]
+    python bench.py rerun [--messages 500] [--reruns 5]
+    python bench.py sse [--stream FILE] [--tokens 100000] [--chunk 4096]
+    python bench.py load [--sessions 8] [--turns 3] [--history 200] [--reasoning 64] [--error-rate 0.05]
+    python bench.py images [--count 12] [--duplicates 4] [--max-side 4000]
+
+所有子命令都向标准输出打印 JSON；python bench.py --output FILE <子命令> 同时写入文件，便于回归比较。
+"""
+import argparse
+import base64
+import io
+import json
+import os
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from PIL import Image
+
+import GUI
+from GUI import (ConversationStore, HttpTransport, ImagePreprocessor, SSEParser, StreamRenderer, UIManager,
+                 headers, json_loads)
+
+
+class QuietHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        pass  # 客户端断开长连接属正常情况
+
+
+class MockServer:
+    """本地模拟的 /v1/chat/completions 端点，可注入延迟与错误
+
+    errors 为按请求顺序返回的状态码列表，用完后正常响应；error_rate 为之后每个请求返回 500 的概率。
+    reasoning 为回答前的推理增量数；stream_errors 为在输出一半时以 SSE 错误事件中断的流式响应数。
+    """
+
+    def __init__(self, ttft=0.0, token_rate=0.0, tokens=32, errors=(), retry_after=None,
+                 reasoning=0, error_rate=0.0, stream_errors=0, seed=0):
+        self.ttft = ttft
+        self.token_rate = token_rate
+        self.tokens = tokens
+        self.errors = list(errors)
+        self.retry_after = retry_after
+        self.reasoning = reasoning
+        self.error_rate = error_rate
+        self.stream_errors = stream_errors
+        self.rng = random.Random(seed)
+        self.requests = 0
+        self.connections = 0
+        self._lock = threading.Lock()
+        self.httpd = QuietHTTPServer(("127.0.0.1", 0), self._handler())
+        self.url = f"http://127.0.0.1:{self.httpd.server_port}/v1/chat/completions"
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def next_error(self):
+        with self._lock:
+            self.requests += 1
+            if self.errors:
+                return self.errors.pop(0)
+            return 500 if self.error_rate and self.rng.random() < self.error_rate else None
+
+    def next_stream_error(self):
+        with self._lock:
+            if self.stream_errors:
+                self.stream_errors -= 1
+                return True
+            return False
+
+    def deltas(self, payload):
+        """生成模拟的增量序列：先推理，后回答"""
+        for i in range(self.reasoning):
+            yield {"reasoning_content": f"think{i} "}
+        for i in range(self.tokens):
+            yield {"content": f"tok{i} "}
+
+    def usage(self, payload):
+        prompt = sum(len(str(msg.get("content", ""))) for msg in payload.get("messages", [])) // 4
+        return {"prompt_tokens": prompt, "completion_tokens": self.reasoning + self.tokens,
+                "total_tokens": prompt + self.reasoning + self.tokens,
+                "completion_tokens_details": {"reasoning_tokens": self.reasoning}}
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                with server._lock:
+                    server.connections += 1
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                status = server.next_error()
+                if status:
+                    body = json.dumps({"message": "injected error"}).encode()
+                    self.send_response(status)
+                    if server.retry_after is not None:
+                        self.send_header("Retry-After", str(server.retry_after))
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                    return
+
+                time.sleep(server.ttft)
+                if not payload.get("stream"):
+                    text = "".join(d.get("content", "") for d in server.deltas(payload))
+                    body = json.dumps({"choices": [{"message": {"role": "assistant", "content": text}}]}).encode()
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                    return
+
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                fail_at = (server.reasoning + server.tokens) // 2 if server.next_stream_error() else None
+                for i, delta in enumerate(server.deltas(payload)):
+                    if i == fail_at:
+                        error = {"error": {"message": "injected stream error", "code": 50001}}
+                        self._chunk(f"data: {json.dumps(error)}\n\n".encode())
+                        break
+                    chunk = {"choices": [{"index": 0, "delta": delta}]}
+                    self._chunk(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode())
+                    if server.token_rate:
+                        time.sleep(1.0 / server.token_rate)
+                else:
+                    chunk = {"choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+                             "usage": server.usage(payload)}
+                    self._chunk(f"data: {json.dumps(chunk)}\n\n".encode())
+                self._chunk(b"data: [DONE]\n\n")
+                self._chunk(b"")
+
+            def _chunk(self, data):
+                self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+                self.wfile.flush()
+
+        return Handler
+
+
+class FakePlaceholder:
+    """模拟 st.empty()，只统计重绘次数与发送的字符数"""
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def markdown(self, text):
+        self.stats["repaints"] += 1
+        self.stats["chars"] += len(text)
+
+    def empty(self):
+        return FakePlaceholder(self.stats)
+
+
+class FakeClock:
+    """按回放速率推进的虚拟时钟"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def synth_stream(tokens, seed=0):
+    """生成包含段落、列表、代码块和公式的模拟增量流"""
+    rng = random.Random(seed)
+    words = ["模型", "推理", "stream", "token", "数据", "latency", "缓存", "渲染", "the", "of"]
+    deltas = []
+    while len(deltas) < tokens:
+        kind = rng.random()
+        if kind < 0.15:
+            block = ["```python\n"] + [f"x_{i} = {i} * 2\n" for i in range(rng.randint(3, 15))] + ["```\n\n"]
+        elif kind < 0.25:
+            block = ["$$\n", "E = mc^2 + \\sum_i x_i\n", "$$\n\n"]
+        elif kind < 0.4:
+            block = [f"- {rng.choice(words)} {rng.choice(words)}\n" for _ in range(rng.randint(2, 6))] + ["\n"]
+        else:
+            block = [rng.choice(words) + " " for _ in range(rng.randint(20, 120))] + ["\n\n"]
+        deltas.extend(block)
+    return deltas[:tokens]
+
+
+def load_stream(path):
+    """从录制的 SSE 文件中读取 content 增量"""
+    deltas = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line.startswith("data:") or line == "data: [DONE]":
+                continue
+            try:
+                delta = json.loads(line[5:])["choices"][0]["delta"]
+            except (json.JSONDecodeError, KeyError, IndexError):
+                continue
+            if delta.get("content"):
+                deltas.append(delta["content"])
+    return deltas
+
+
+def bench_render(args):
+    deltas = load_stream(args.stream) if args.stream else synth_stream(args.tokens)
+    step = 1.0 / args.rate
+
+    # 旧实现：每个增量都对完整文本重新规范化并重绘
+    naive = {"repaints": 0, "chars": 0}
+    placeholder = FakePlaceholder(naive)
+    start = time.perf_counter()
+    full = ""
+    for delta in deltas:
+        full += delta
+        placeholder.markdown(UIManager.normalize_latex(full + "▌"))
+    naive["seconds"] = time.perf_counter() - start
+
+    # 新实现：按时间/长度预算合并，仅重绘尾部
+    incremental = {"repaints": 0, "chars": 0}
+    clock = FakeClock()
+    renderer = StreamRenderer(FakePlaceholder(incremental), clock=clock)
+    start = time.perf_counter()
+    for delta in deltas:
+        clock.now += step
+        renderer.feed(delta)
+    renderer.finish()
+    incremental["seconds"] = time.perf_counter() - start
+    incremental["segments"] = len(renderer.frozen)
+
+    assert renderer.text == full
+    return {"deltas": len(deltas), "chars": len(full), "naive": naive, "incremental": incremental}
+
+
+def time_stream(post):
+    """返回 (首个增量耗时, 总耗时)"""
+    start = time.perf_counter()
+    ttft = None
+    with post() as response:
+        for line in response.iter_lines():
+            if line and ttft is None:
+                ttft = time.perf_counter() - start
+    return ttft, time.perf_counter() - start
+
+
+def bench_transport(args):
+    payload = {"model": "mock", "messages": [{"role": "user", "content": "hi"}], "stream": True}
+    results = {}
+
+    with MockServer(ttft=args.ttft) as server:
+        # 旧实现：每轮直接 requests.post，新建连接
+        samples = [time_stream(lambda: requests.post(server.url, json=payload, headers=headers, stream=True))
+                   for _ in range(args.turns)]
+        results["fresh"] = summarize(samples, server.connections)
+
+    with MockServer(ttft=args.ttft) as server:
+        transport = HttpTransport()
+        samples = [time_stream(lambda: transport.post(server.url, payload, headers, stream=True))
+                   for _ in range(args.turns)]
+        results["pooled"] = summarize(samples, server.connections)
+
+    with MockServer(errors=[429] * args.fail, retry_after=0) as server:
+        transport = HttpTransport(backoff=0.01)
+        start = time.perf_counter()
+        with transport.post(server.url, payload, headers, stream=True) as response:
+            status = response.status_code
+        results["retry"] = {"injected": args.fail, "attempts": server.requests,
+                            "status": status, "seconds": time.perf_counter() - start}
+    return results
+
+
+def summarize(samples, connections):
+    ttfts = sorted(t for t, _ in samples)
+    totals = sorted(t for _, t in samples)
+    return {"turns": len(samples), "connections": connections,
+            "ttft_p50_ms": ttfts[len(ttfts) // 2] * 1000,
+            "total_p50_ms": totals[len(totals) // 2] * 1000}
+
+
+def synth_conversation(length, image_kb, seed=0):
+    """生成模拟对话：每 10 条消息含一张内嵌图片"""
+    rng = random.Random(seed)
+    image = base64.b64encode(rng.randbytes(image_kb * 1024)).decode()
+    messages = []
+    for i in range(length):
+        if i % 2 == 0:
+            content = "问题 " * rng.randint(10, 100)
+            if i % 10 == 0:
+                content = [{"type": "image_url", "image_url": {"url": f"data:image/png;base64,{image}"}},
+                           {"type": "text", "text": content}]
+            messages.append({"role": "user", "content": content})
+        else:
+            messages.append({"role": "assistant", "content": "回答 " * rng.randint(100, 800), "reasoning": ""})
+    return messages
+
+
+def bench_save(args):
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for length in (int(n) for n in args.lengths.split(",")):
+            messages = synth_conversation(length, args.image_kb)
+
+            # 旧格式：每轮整体重写带缩进的 JSON
+            legacy = os.path.join(tmp, f"{length}.json")
+            start = time.perf_counter()
+            with open(legacy, 'w', encoding='utf-8') as f:
+                json.dump(messages, f, ensure_ascii=False, indent=2)
+            legacy_ms = (time.perf_counter() - start) * 1000
+
+            # 新格式：只追加本轮的一问一答（含 fsync）
+            journal = os.path.join(tmp, f"{length}.jsonl")
+            ConversationStore.write(journal, messages[:-2])
+            start = time.perf_counter()
+            ConversationStore.append(journal, messages[-2:])
+            append_ms = (time.perf_counter() - start) * 1000
+
+            results.append({"messages": length, "legacy_ms": round(legacy_ms, 3),
+                            "append_ms": round(append_ms, 3),
+                            "legacy_bytes": os.path.getsize(legacy), "journal_bytes": os.path.getsize(journal)})
+    return results
+
+
+def bench_rerun(args):
+    from streamlit.testing.v1 import AppTest
+
+    messages = synth_conversation(args.messages, image_kb=16)
+    results = {}
+    for label, window in (("full", args.messages), ("windowed", None)):
+        at = AppTest.from_file("GUI.py", default_timeout=120)
+        at.session_state["messages"] = messages
+        if window:
+            at.session_state["history_window"] = window
+        timings = []
+        for _ in range(args.reruns + 1):
+            start = time.perf_counter()
+            at.run()
+            timings.append(time.perf_counter() - start)
+        if at.exception:
+            raise RuntimeError(at.exception[0].value)
+        # 第一次运行包含缓存预热
+        warm = sorted(timings[1:])
+        results[label] = {"first_ms": round(timings[0] * 1000, 1),
+                          "rerun_p50_ms": round(warm[len(warm) // 2] * 1000, 1),
+                          "elements": len(at.markdown)}
+    return results
+
+
+def load_app(history=None):
+    """load 子命令中每个模拟会话运行的页面脚本"""
+    import os
+    import streamlit as st
+    import GUI
+    GUI.BASE_URL = os.environ["BENCH_MOCK_URL"]
+    if history and "bench_loaded" not in st.session_state:
+        GUI.SessionManager.init_session()
+        GUI.FileManager.load_conversation(history)
+        st.session_state.bench_loaded = True
+    GUI.main()
+
+
+def instrument_history_io(stats):
+    """为对话文件读写计时（只影响当前进程）"""
+    store = GUI.ConversationStore
+    lock = threading.Lock()
+    originals = {name: getattr(store, name) for name in ("append", "write", "read", "read_range", "offsets")}
+
+    def timed(name, func):
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                with lock:
+                    stats.setdefault(name, []).append((time.perf_counter() - start) * 1000)
+        return staticmethod(wrapper)
+
+    for name, func in originals.items():
+        setattr(store, name, timed(name, func))
+
+
+def percentiles(values, scale=1.0):
+    quantile = GUI.MetricsStore.quantile
+    return {"p50": round(quantile(values, 0.5) * scale, 1) if values else None,
+            "p95": round(quantile(values, 0.95) * scale, 1) if values else None,
+            "max": round(max(values) * scale, 1) if values else None}
+
+
+def run_session(n, args, workdir, history):
+    """一个模拟用户（在独立进程中运行）：打开页面（可选加载长对话），连续提问若干轮，再空闲重跑若干次"""
+    from streamlit.testing.v1 import AppTest
+
+    os.chdir(workdir)
+    sys.stdout = open(os.devnull, 'w')  # 应用日志不混入结果 JSON
+    report = {"first_run": [], "turns": [], "runs_per_turn": [], "reruns": [], "exceptions": [], "io": {}}
+    instrument_history_io(report["io"])
+    if args.trace_memory:
+        tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    at = AppTest.from_function(load_app, args=(history,), default_timeout=args.timeout)
+    start = time.perf_counter()
+    at.run()
+    report["first_run"].append(time.perf_counter() - start)
+    for turn in range(args.turns):
+        state = at.session_state
+        expected = state["message_offset"] + len(state["messages"]) + 2
+        start = time.perf_counter()
+        at.chat_input[0].set_value(f"会话 {n} 第 {turn} 轮：请解释一下连接池").run()
+        runs = 1
+        # 回答由后台任务生成，未完成时继续重跑直到回答并入会话
+        while at.session_state["message_offset"] + len(at.session_state["messages"]) < expected \
+                and time.perf_counter() - start < args.timeout:
+            time.sleep(0.01)
+            at.run()
+            runs += 1
+        report["turns"].append(time.perf_counter() - start)
+        report["runs_per_turn"].append(runs)
+        if at.exception:
+            report["exceptions"].append(at.exception[0].value)
+    for _ in range(args.reruns):
+        start = time.perf_counter()
+        at.run()
+        report["reruns"].append(time.perf_counter() - start)
+    messages = at.session_state["messages"]
+    # 会话中消息的序列化大小；--trace-memory 时为进程内分配的全部内存（含共享缓存）
+    report["memory_kb"] = ((tracemalloc.get_traced_memory()[0] - baseline) if args.trace_memory
+                           else len(ConversationStore.encode(messages))) / 1024
+    report["failed"] = sum(1 for msg in messages if str(msg.get("reasoning", "")).startswith("错误信息"))
+    report["loaded_messages"] = len(messages)
+    return report
+
+
+def bench_load(args):
+    # AppTest 依赖进程级的运行时单例，不能在同一进程中并发运行，因此每个会话一个进程；
+    # 各进程共享同一个模拟端点与对话目录（对话记录、索引、指标与缓存都写入临时目录）
+    workdir = tempfile.mkdtemp(prefix="bench-load-")
+    os.makedirs(os.path.join(workdir, GUI.BLOB_DIR), exist_ok=True)
+    try:
+        histories = [None] * args.sessions
+        if args.history:
+            for n in range(args.sessions):
+                histories[n] = f"0101{n:04d}_历史对话{n}.jsonl"
+                GUI.ConversationStore.write(os.path.join(workdir, GUI.HISTORY_DIR, histories[n]),
+                                            synth_conversation(args.history, image_kb=0, seed=n))
+        # 先在主进程建好索引，避免各会话进程同时迁移与建全文索引
+        GUI.ConversationIndex(os.path.join(workdir, GUI.HISTORY_DIR)).conn.close()
+        with MockServer(ttft=args.ttft, token_rate=args.rate, tokens=args.tokens, reasoning=args.reasoning,
+                        error_rate=args.error_rate, stream_errors=args.stream_errors, seed=args.seed) as server:
+            os.environ["BENCH_MOCK_URL"] = server.url
+            start = time.perf_counter()
+            with ProcessPoolExecutor(max_workers=args.sessions) as executor:
+                reports = list(executor.map(run_session, range(args.sessions), [args] * args.sessions,
+                                            [workdir] * args.sessions, histories))
+            elapsed = time.perf_counter() - start
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    def merged(key):
+        return [value for report in reports for value in report[key]]
+
+    io_stats = {}
+    for report in reports:
+        for name, values in report["io"].items():
+            io_stats.setdefault(name, []).extend(values)
+    quantile = GUI.MetricsStore.quantile
+    return {
+        "config": {key: getattr(args, key) for key in (
+            "sessions", "turns", "history", "tokens", "reasoning", "ttft", "rate", "error_rate", "stream_errors",
+            "trace_memory")},
+        "seconds": round(elapsed, 2),
+        "turns": {"count": len(merged("turns")), **percentiles(merged("turns"), 1000),
+                  "runs_p50": quantile(merged("runs_per_turn"), 0.5)},
+        "first_run_ms": percentiles(merged("first_run"), 1000),
+        "rerun_ms": percentiles(merged("reruns"), 1000),
+        "memory_per_session_kb": percentiles([report["memory_kb"] for report in reports]),
+        "loaded_messages_p50": quantile([report["loaded_messages"] for report in reports], 0.5),
+        "history_io_ms": {name: {"calls": len(values), "total": round(sum(values), 1), **percentiles(values)}
+                          for name, values in sorted(io_stats.items())},
+        "server": {"requests": server.requests, "connections": server.connections},
+        "failed_replies": sum(report["failed"] for report in reports),
+        "exceptions": merged("exceptions")[:5]
+    }
+
+
+def captured_stream(args):
+    """读取录制的 SSE 原始字节，或由模拟增量生成（推理与回答交替）"""
+    if args.stream:
+        with open(args.stream, "rb") as f:
+            return f.read()
+    parts = []
+    for i, text in enumerate(synth_stream(args.tokens)):
+        key = "reasoning_content" if i < args.tokens // 3 else "content"
+        chunk = {"id": "bench", "object": "chat.completion.chunk", "model": "mock",
+                 "choices": [{"index": 0, "delta": {key: text}, "finish_reason": None}]}
+        parts.append(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n")
+    parts.append("data: [DONE]\n\n")
+    return "".join(parts).encode("utf-8")
+
+
+def fake_response(data):
+    response = requests.Response()
+    response.raw = io.BytesIO(data)
+    response.status_code = 200
+    return response
+
+
+def bench_sse(args):
+    data = captured_stream(args)
+    mb = len(data) / 1024 / 1024
+    results = {"bytes": len(data)}
+
+    # 旧实现：iter_lines + str.replace + json.loads
+    start = time.perf_counter()
+    events = 0
+    chars = 0
+    for chunk in fake_response(data).iter_lines(chunk_size=args.chunk):
+        if chunk:
+            chunk_str = chunk.decode('utf-8').replace('data: ', '')
+            if chunk_str != "[DONE]":
+                try:
+                    chunk_data = json.loads(chunk_str)
+                except json.JSONDecodeError:
+                    continue
+                delta = chunk_data.get('choices', [{}])[0].get('delta', {})
+                chars += len(delta.get('content', '')) + len(delta.get('reasoning_content', ''))
+                events += 1
+    elapsed = time.perf_counter() - start
+    results["legacy"] = {"events": events, "chars": chars, "seconds": round(elapsed, 4),
+                         "mb_per_s": round(mb / elapsed, 1), "events_per_s": round(events / elapsed)}
+
+    # 新实现：SSEParser 直接处理字节块
+    start = time.perf_counter()
+    events = 0
+    chars = 0
+    for delta in SSEParser().parse(fake_response(data).iter_content(chunk_size=args.chunk)):
+        if not delta.done:
+            chars += len(delta.content) + len(delta.reasoning)
+            events += 1
+    elapsed = time.perf_counter() - start
+    results["parser"] = {"events": events, "chars": chars, "seconds": round(elapsed, 4),
+                         "mb_per_s": round(mb / elapsed, 1), "events_per_s": round(events / elapsed),
+                         "json": json_loads.__module__}
+    return results
+
+
+def synth_image(rng, index, max_side):
+    """生成模拟上传图片：带 EXIF 的手机照片、带透明通道的 PNG 与小截图轮流出现"""
+    kind = index % 3
+    if kind == 2:
+        size = (rng.randint(200, 800), rng.randint(200, 600))
+    else:
+        side = rng.randint(max_side // 2, max_side)
+        size = (side, side * 3 // 4)
+    # 照片用渐变叠加噪声，压缩率接近真实照片；透明 PNG 多为图标、示意图等平坦图形
+    gradient = Image.linear_gradient("L").resize(size)
+    if kind == 1:
+        noise = gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT)
+    else:
+        noise = Image.effect_noise(size, rng.randint(10, 60))
+    image = Image.merge("RGB", (gradient, noise, gradient.transpose(Image.Transpose.ROTATE_180)))
+    out = io.BytesIO()
+    if kind == 0:
+        exif = Image.Exif()
+        exif[0x010F] = "BenchCam"  # Make
+        exif[0x0112] = 6           # Orientation：需要旋转 90 度
+        image.save(out, "JPEG", quality=95, exif=exif.tobytes())
+        return out.getvalue(), "image/jpeg"
+    if kind == 1:
+        image.putalpha(gradient)
+    image.save(out, "PNG")
+    return out.getvalue(), "image/png"
+
+
+def bench_images(args):
+    rng = random.Random(args.seed)
+    corpus = [synth_image(rng, i, args.max_side) for i in range(args.count)]
+    images = corpus + [rng.choice(corpus) for _ in range(args.duplicates)]
+    rng.shuffle(images)
+    limit = GUI.IMAGE_MAX_SIDE.get(args.model, GUI.DEFAULT_IMAGE_MAX_SIDE)
+
+    start = time.perf_counter()
+    results, stats = ImagePreprocessor.run(images, model=args.model, workers=args.workers)
+    elapsed = time.perf_counter() - start
+
+    longest = 0
+    with_exif = 0
+    for data, _ in results:
+        image = Image.open(io.BytesIO(data))
+        longest = max(longest, max(image.size))
+        with_exif += bool(image.getexif())
+    checks = {
+        "max_side": longest <= limit,
+        "exif_removed": with_exif == 0,
+        "duplicates_skipped": stats["duplicates"] == args.duplicates and len(results) == args.count,
+        "bytes_reduced": stats["processed_bytes"] < stats["original_bytes"],
+    }
+    return {**stats, "unique": len(results), "limit": limit, "longest_side": longest, "with_exif": with_exif,
+            "seconds": round(elapsed, 3), "images_per_s": round(len(results) / elapsed, 1),
+            "checks": checks, "passed": all(checks.values())}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="离线基准测试")
+    parser.add_argument("--output", help="同时把结果 JSON 写入文件")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    render = sub.add_parser("render", help="流式渲染：重绘次数与耗时")
+    render.add_argument("--stream", help="录制的 SSE 文件（默认生成模拟流）")
+    render.add_argument("--tokens", type=int, default=100000, help="模拟流的增量数")
+    render.add_argument("--rate", type=float, default=60.0, help="回放速率（增量/秒）")
+    render.set_defaults(func=bench_render)
+
+    transport = sub.add_parser("transport", help="连接复用与重试：首字延迟与尝试次数")
+    transport.add_argument("--turns", type=int, default=20, help="对话轮数")
+    transport.add_argument("--ttft", type=float, default=0.05, help="模拟首字延迟（秒）")
+    transport.add_argument("--fail", type=int, default=2, help="注入的 429 次数")
+    transport.set_defaults(func=bench_transport)
+
+    save = sub.add_parser("save", help="对话保存：整体重写与追加日志的耗时对比")
+    save.add_argument("--lengths", default="10,50,100,200,500", help="对话长度列表")
+    save.add_argument("--image-kb", type=int, default=200, help="每张内嵌图片的大小（KB）")
+    save.set_defaults(func=bench_save)
+
+    rerun = sub.add_parser("rerun", help="长对话的页面重跑耗时（Streamlit AppTest）")
+    rerun.add_argument("--messages", type=int, default=500, help="对话消息数")
+    rerun.add_argument("--reruns", type=int, default=5, help="重跑次数")
+    rerun.set_defaults(func=bench_rerun)
+
+    sse = sub.add_parser("sse", help="SSE 解析吞吐：MB/s 与 events/s")
+    sse.add_argument("--stream", help="录制的 SSE 原始文件（默认生成模拟流）")
+    sse.add_argument("--tokens", type=int, default=100000, help="模拟流的增量数")
+    sse.add_argument("--chunk", type=int, default=4096, help="网络读取块大小（字节）")
+    sse.set_defaults(func=bench_sse)
+
+    load = sub.add_parser("load", help="多会话并发压测（Streamlit AppTest + 模拟端点）")
+    load.add_argument("--sessions", type=int, default=8, help="并发会话数")
+    load.add_argument("--turns", type=int, default=3, help="每个会话的提问轮数")
+    load.add_argument("--reruns", type=int, default=3, help="提问结束后的空闲重跑次数")
+    load.add_argument("--history", type=int, default=0, help="每个会话先加载的历史消息数（0 表示新对话）")
+    load.add_argument("--tokens", type=int, default=200, help="每个回答的增量数")
+    load.add_argument("--reasoning", type=int, default=64, help="每个回答前的推理增量数")
+    load.add_argument("--ttft", type=float, default=0.2, help="模拟首字延迟（秒）")
+    load.add_argument("--rate", type=float, default=500.0, help="模拟输出速率（增量/秒）")
+    load.add_argument("--error-rate", type=float, default=0.0, help="请求返回 500 的概率")
+    load.add_argument("--stream-errors", type=int, default=0, help="中途出错的流式响应数")
+    load.add_argument("--seed", type=int, default=0)
+    load.add_argument("--trace-memory", action="store_true",
+                      help="用 tracemalloc 统计每会话内存（会显著拖慢延迟指标）")
+    load.add_argument("--timeout", type=float, default=120.0, help="单轮超时（秒）")
+    load.set_defaults(func=bench_load)
+
+    images = sub.add_parser("images", help="图片预处理：缩放、去除 EXIF、去重与压缩效果")
+    images.add_argument("--count", type=int, default=12, help="不重复的图片数")
+    images.add_argument("--duplicates", type=int, default=4, help="额外混入的重复图片数")
+    images.add_argument("--max-side", type=int, default=4000, help="生成图片的最长边上限（像素）")
+    images.add_argument("--model", default=GUI.VLM_MODEL, help="按该模型的最长边限制处理")
+    images.add_argument("--workers", type=int, default=GUI.IMAGE_WORKERS, help="并行处理线程数")
+    images.add_argument("--seed", type=int, default=0)
+    images.set_defaults(func=bench_images)
+
+    args = parser.parse_args()
+    stats = args.func(args)
+    result = json.dumps(stats, ensure_ascii=False, indent=2)
+    print(result)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(result + "\n")
+    if isinstance(stats, dict) and stats.get("passed") is False:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()